@@ -0,0 +1,342 @@
+import os
+import time
+import logging
+import asyncio
+import weakref
+import httpx
+import requests
+from api.config import address_to_segment, group_config, SEGMENT_URL, SPOT_URL, MAX_SEGMENT_IDS, SPOT_PAGE_SIZE, \
+    SPOT_MAX_PAGES
+from api.circuit import CircuitOpenError, is_upstream_failure
+from api.context import QueryContext
+from api.fairness import current_user, SYSTEM_USER
+from api.jsonstream import ArrayItemDecoder
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 同一個事件迴圈中同時對 TDX 發出的請求上限
+TDX_MAX_CONCURRENCY = int(os.getenv("TDX_MAX_CONCURRENCY", default=4))
+
+
+class AsyncParkingFinder:
+    """
+    ParkingFinder 查詢流程的非同步版本，以 httpx.AsyncClient 呼叫 TDX，不阻塞事件迴圈。
+
+    多個 20 ID 批次、路段名稱與動態車格查詢會並行送出，並以每個事件迴圈一個 Semaphore
+    限制同時請求數。Access Token、路段名稱快取、斷路器與最後成功結果皆與同步的
+    ParkingFinder 共用，回傳格式也與 ParkingFinder.find_grouped_parking_spots 相同；Token 到期時
+    在執行緒中沿用同步的取得流程，與同步查詢共用同一把 refresh_lock。
+    """
+
+    def __init__(self, finder, max_concurrency=TDX_MAX_CONCURRENCY):
+        self.finder = finder
+        self.max_concurrency = max_concurrency
+        # asyncio 同步物件綁定事件迴圈，依迴圈各建一份（index.py 每次 asyncio.run 都是新迴圈）
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def _call_upstream(self, client, endpoint, method, url, consume=None, **kwargs):
+        """
+        經由共用的斷路器呼叫 TDX，並以 Semaphore 限制並行數。
+
+        指定 consume 時以串流方式請求，在持有名額與斷路器保護內 await consume(response) 讀完內容並返回其結果；
+        讀取途中的逾時、連線中斷或內容不完整（ValueError）都計為上游失敗。
+        """
+        breaker = self.finder.breakers[endpoint]
+        if not breaker.allow_request():
+            raise CircuitOpenError("TDX {} 端點暫時異常，{:.0f} 秒後重試".format(endpoint, breaker.retry_after()))
+        settled = False
+        try:
+            async with self.finder.fair_scheduler.slot_async(), self._semaphore():
+                try:
+                    if consume is not None:
+                        response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+                        try:
+                            if response.is_error:
+                                # 錯誤回應先讀完，錯誤處理才能讀取內容
+                                await response.aread()
+                            response.raise_for_status()
+                            result = await consume(response)
+                        finally:
+                            await response.aclose()
+                    else:
+                        response = await client.request(method, url, **kwargs)
+                        response.raise_for_status()
+                        result = response
+                except httpx.HTTPError as e:
+                    if is_upstream_failure(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    settled = True
+                    raise
+                except ValueError:
+                    breaker.record_failure()
+                    settled = True
+                    raise
+            breaker.record_success()
+            settled = True
+        finally:
+            # 排隊、請求或讀取途中被取消時，釋放半開的探測名額，否則斷路器會一直拒絕呼叫
+            if not settled:
+                breaker.release_probe()
+        return result
+
+    async def _get_access_token(self, query):
+        token = self.finder.tokens.get()
+        if token:
+            return token
+        # 與同步查詢共用 TokenCache.refresh_lock，所有執行緒與事件迴圈同時到期時只取一次 Token；
+        # 取得 Token 的請求在執行緒中進行，不阻塞事件迴圈
+        try:
+            return await asyncio.to_thread(self.finder._get_access_token, query)
+        except requests.exceptions.RequestException as e:
+            raise Exception("取得 Access Token 失敗：查詢失敗，請檢查網路或稍後再試（{}）".format(str(e)))
+
+    async def _get_data_header(self, client, query):
+        return {
+            'authorization': 'Bearer {}'.format(await self._get_access_token(query)),
+            'Accept-Encoding': 'gzip'
+        }
+
+    async def _get_parking_segments(self, client, city, address, query):
+        url = SEGMENT_URL.format(city)
+        params = {"$format": "JSON", "$top": 100, "$select": "ParkingSegmentID,ParkingSegmentName",
+                  "$filter": "contains(ParkingSegmentName/Zh_tw,'{}')".format(address)}
+        try:
+            logger.info("開始路段查詢，地址: {}".format(address))
+            response = await self._call_upstream(client, "segment", "GET", url,
+                                                 headers=await self._get_data_header(client, query), params=params)
+            data = response.json()
+            query.count_call()
+            if data.get("ParkingSegments"):
+                for segment in data.get("ParkingSegments", []):
+                    seg_id = segment.get("ParkingSegmentID")
+                    self.finder.segment_name_cache.set(seg_id,
+                                                       segment.get("ParkingSegmentName", {}).get("Zh_tw", "未知路段"))
+                return data
+            return {"error": "路段查詢錯誤：無匹配路段", "api_response": data}
+        except httpx.TimeoutException:
+            logger.error("路段查詢錯誤 (地址: {}): 請求超時 (504 Gateway Timeout)".format(address))
+            return {"error": "路段查詢錯誤：請求超時，請稍後再試", "api_response": {}}
+        except httpx.HTTPStatusError as e:
+            logger.error("路段查詢錯誤 (地址: {}): {}".format(address, str(e)))
+            if e.response.status_code == 429:
+                return {"error": "路段查詢錯誤：API 速率限制，請稍後再試", "api_response": {}}
+            error = "路段查詢錯誤：伺服器錯誤，請稍後再試" if e.response.status_code == 500 \
+                else "路段查詢錯誤：查詢失敗，請檢查網路或稍後再試"
+            try:
+                return {"error": error, "api_response": e.response.json()}
+            except ValueError:
+                return {"error": error, "api_response": {"error": e.response.text}}
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("路段查詢錯誤 (地址: {}): {}".format(address, str(e)))
+            return {"error": "路段查詢錯誤：查詢失敗，請檢查網路或稍後再試", "api_response": {"error": str(e)}}
+
+    async def _get_segment_name_batch(self, client, city, batch_ids, query):
+        url = SEGMENT_URL.format(city)
+        try:
+            logger.info("開始路段名稱查詢，路段 ID: {}".format(batch_ids))
+            response = await self._call_upstream(client, "segment_name", "GET", url,
+                                                 headers=await self._get_data_header(client, query),
+                                                 params=self.finder._segment_name_params(batch_ids))
+            data = response.json()
+            query.count_call()
+            return self.finder._parse_segment_names(data, batch_ids)
+        except httpx.TimeoutException:
+            logger.error("路段名稱查詢錯誤: 請求超時 (504 Gateway Timeout)")
+            return {seg_id: {"error": "路段名稱查詢錯誤：請求超時", "api_response": {}} for seg_id in batch_ids}
+        except httpx.HTTPStatusError as e:
+            logger.error("路段名稱查詢錯誤: {}".format(str(e)))
+            return self.finder._segment_name_http_error(e.response, batch_ids)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("路段名稱查詢錯誤: {}".format(str(e)))
+            return {seg_id: {"error": "路段名稱查詢錯誤：查詢失敗", "api_response": {"error": str(e)}}
+                    for seg_id in batch_ids}
+
+    async def _get_segment_names(self, client, city, segment_ids, query):
+        cached_names, uncached_ids = self.finder.segment_name_cache.lookup(segment_ids)
+        batches = [uncached_ids[i:i + MAX_SEGMENT_IDS] for i in range(0, len(uncached_ids), MAX_SEGMENT_IDS)]
+        result = {}
+        for batch_result in await asyncio.gather(
+                *[self._get_segment_name_batch(client, city, batch_ids, query) for batch_ids in batches]):
+            result.update(batch_result)
+        for seg_id in segment_ids:
+            if seg_id not in result and seg_id in cached_names:
+                result[seg_id] = cached_names[seg_id]
+        return result
+
+    async def _get_spot_batch(self, client, city, batch_ids, spot_number, query, headers=None):
+        """查詢一批動態車格，分頁方式與返回格式與 ParkingFinder._get_spot_batch 相同。"""
+        finder = self.finder
+        url = SPOT_URL.format(city)
+        try:
+            start_time = time.time()
+            headers = headers or await self._get_data_header(client, query)
+            spots = []
+            seen = set()
+            for page in range(SPOT_MAX_PAGES):
+                params = finder._spot_params(batch_ids, spot_number, skip=page * SPOT_PAGE_SIZE)
+                logger.info("開始動態車格查詢，路段 ID: {}，過濾條件: {}，第 {} 頁".format(
+                    batch_ids, params["$filter"], page + 1))
+                page_spots = await self._call_upstream(client, "spot", "GET", url, consume=self._read_spots,
+                                                       params=params, headers=headers)
+                query.count_call()
+                spots.extend(finder._new_spots(page_spots, seen))
+                if len(page_spots) < SPOT_PAGE_SIZE:
+                    logger.info("動態車格查詢成功，耗時 {} 秒".format(time.time() - start_time))
+                    return {"CurbSpotParkingAvailabilities": spots, "calls": page + 1}
+            return finder._spot_overflow_error(batch_ids)
+        except httpx.TimeoutException:
+            logger.error("動態車格查詢錯誤: 請求超時 (504 Gateway Timeout)")
+            return {"error": "動態車格查詢錯誤：請求超時，請稍後再試", "api_response": {},
+                    "api_responses": {seg_id: {"error": "請求超時"} for seg_id in batch_ids}}
+        except httpx.HTTPStatusError as e:
+            return self.finder._spot_http_error(e.response, batch_ids)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("動態車格查詢錯誤: {}".format(str(e)))
+            return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試", "api_response": {"error": str(e)},
+                    "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
+        except ValueError as e:
+            return self.finder._spot_format_error(e, batch_ids)
+
+    async def _read_spots(self, response):
+        """邊下載邊解析動態車格回應，返回精簡後的車格列表。"""
+        decoder = ArrayItemDecoder("CurbSpotParkingAvailabilities")
+        spots = []
+        async for chunk in response.aiter_bytes():
+            spots.extend(self.finder._compact_spot(item) for item in decoder.feed(chunk))
+        spots.extend(self.finder._compact_spot(item) for item in decoder.close())
+        return spots
+
+    async def _fetch_spot_batches(self, city, batches, batch_users, headers):
+        """
+        送出合併後的動態車格批次；由合併器的獨立任務呼叫，使用自己的 client，不受發起的查詢結束或取消影響。
+        各批次依參與用戶的虛擬時間排程，呼叫數由各參與的查詢依用到的批次數自行計入。
+        """
+        query = QueryContext(user_id=SYSTEM_USER)
+        async with httpx.AsyncClient(timeout=5) as client:
+            return await asyncio.gather(
+                *[self._get_shared_spot_batch(client, city, batch_ids, user_ids, query, headers)
+                  for batch_ids, user_ids in zip(batches, batch_users)])
+
+    async def _get_shared_spot_batch(self, client, city, batch_ids, user_ids, query, headers):
+        # gather 為每個批次建立各自的任務，for_users 只影響這個批次
+        with self.finder.fair_scheduler.for_users(user_ids):
+            return await self._get_spot_batch(client, city, batch_ids, None, query, headers)
+
+    async def _get_parking_spots(self, client, city, segment_ids, spot_number, query):
+        if not segment_ids:
+            return {"error": "動態車格查詢錯誤：無有效的路段 ID", "api_response": {}}
+
+        if spot_number:
+            batches = [segment_ids[i:i + MAX_SEGMENT_IDS] for i in range(0, len(segment_ids), MAX_SEGMENT_IDS)]
+            batch_results = await asyncio.gather(
+                *[self._get_spot_batch(client, city, batch_ids, spot_number, query) for batch_ids in batches])
+        else:
+            # 與同一事件迴圈中的其他監控合併成共用的 20 ID 批次；Token 由此查詢取得並計入
+            headers = await self._get_data_header(client, query)
+            data, calls = await self.finder.spot_planner.fetch_async(
+                city, segment_ids, lambda batches, batch_users: self._fetch_spot_batches(city, batches, batch_users, headers))
+            self.finder._charge_shared_calls(query, calls)
+            batches = [segment_ids]
+            batch_results = [data]
+
+        # 依批次順序合併，與同步版本一樣遇到第一個錯誤即返回
+        all_spots = []
+        collect_times = {}
+        api_responses = self.finder._empty_spot_responses(segment_ids)
+        for batch_ids, data in zip(batches, batch_results):
+            if "error" in data:
+                return data
+            error = self.finder._collect_spot_batch(data, batch_ids, api_responses, all_spots, collect_times)
+            if error:
+                return error
+        return {"CurbSpotParkingAvailabilities": all_spots, "api_response": {"batched": True},
+                "api_responses": api_responses, "collect_times": collect_times}
+
+    async def get_segment_names(self, city, segment_ids):
+        """非同步查詢路段名稱（已快取者不呼叫 API）。"""
+        async with httpx.AsyncClient(timeout=5) as client:
+            return await self._get_segment_names(client, city, segment_ids, QueryContext(user_id=current_user.get()))
+
+    async def find_grouped_parking_spots(self, address, spot_number=None):
+        """
+        非同步查詢指定地址的停車位狀態，行為與 ParkingFinder.find_grouped_parking_spots 相同。
+
+        Returns:
+            tuple: (response_text, error_msgs, api_responses, available_spot_ids)
+        """
+        return self.finder.as_tuple(await self.find_grouped_parking_data(address, spot_number))
+
+    async def find_grouped_parking_data(self, address, spot_number=None):
+        """非同步版本的 ParkingFinder.find_grouped_parking_data，返回包含結構化分組資料的 dict。"""
+        finder = self.finder
+        key = (address, spot_number)
+        over_quota = finder._serve_over_quota(key)
+        if over_quota is not None:
+            return over_quota
+        # 此查詢用到的端點斷路器未恢復時直接回應快取，不等待上游逾時
+        if not finder._upstream_healthy(address):
+            stale = finder._serve_stale(key)
+            if stale is not None:
+                return stale
+
+        failures_before = finder._upstream_failure_count(address)
+        try:
+            result = await self._query_grouped_parking_spots(address, spot_number)
+        except Exception:
+            stale = finder._serve_stale(key)
+            if stale is not None:
+                return stale
+            raise
+        return finder._settle_result(key, result, failures_before)
+
+    async def _query_grouped_parking_spots(self, address, spot_number=None):
+        finder = self.finder
+        # 每次查詢各自的上下文與計數，並行查詢不互相覆蓋
+        query = QueryContext(address, spot_number, current_user.get())
+        error_msgs = []
+        api_responses = []
+
+        city, remaining_address, address_error = finder._normalize_address(address)
+        if address_error:
+            error_msgs.append(address_error)
+            return finder._error_result(error_msgs, api_responses, query.api_calls)
+
+        async with httpx.AsyncClient(timeout=5) as client:
+            if remaining_address in address_to_segment:
+                segment_ids, segment_groups, segment_names = finder._resolve_alias_segments(remaining_address)
+                spot_data = await self._get_parking_spots(client, city, segment_ids, spot_number, query)
+            else:
+                segment_data = await self._get_parking_segments(client, city, remaining_address, query)
+                if "error" in segment_data:
+                    error_msgs.append("找不到 {} 的路段資料：{}。\n請嘗試以下地址：{}".format(
+                        remaining_address, segment_data["error"], ", ".join(address_to_segment.keys())))
+                    api_responses.append(segment_data["api_response"])
+                    return finder._error_result(error_msgs, api_responses, query.api_calls)
+                segment_ids = [s["ParkingSegmentID"] for s in segment_data["ParkingSegments"] if
+                               "ParkingSegmentID" in s]
+                segment_groups = {seg_id: [g["name"] for g in group_config.get(seg_id, [])] for seg_id in segment_ids}
+                # 路段名稱與動態車格互不相依，同時查詢
+                segment_names, spot_data = await asyncio.gather(
+                    self._get_segment_names(client, city, segment_ids, query),
+                    self._get_parking_spots(client, city, segment_ids, spot_number, query))
+                for seg_id, name_info in segment_names.items():
+                    if isinstance(name_info, dict) and "error" in name_info:
+                        error_msgs.append("無法查詢路段 {} 的名稱：{}。".format(seg_id, name_info["error"]))
+                        api_responses.append(name_info["api_response"])
+
+        if "error" in spot_data:
+            error_msgs.append("無法查詢 {} 的車位資料：{}。".format(remaining_address, spot_data["error"]))
+            api_responses.append(spot_data["api_response"])
+            return finder._error_result(error_msgs, api_responses, query.api_calls)
+        return finder._build_grouped_response(remaining_address, segment_ids, segment_groups, segment_names,
+                                              spot_data, error_msgs, api_responses, query.api_calls)
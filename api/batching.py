@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import asyncio
+import weakref
+import threading
+from concurrent.futures import Future
+from api.config import MAX_SEGMENT_IDS
+from api.fairness import current_user
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 合併同時進行的動態車格查詢的等待時間（毫秒，0 為關閉合併）
+SPOT_BATCH_WINDOW_MS = float(os.getenv("SPOT_BATCH_WINDOW_MS", default=5))
+
+
+def plan_batches(demands, max_ids=MAX_SEGMENT_IDS):
+    """將多個查詢需要的路段 ID 去重後依序切成最少的批次（每批最多 max_ids 個）。"""
+    unique_ids = []
+    seen = set()
+    for segment_ids in demands:
+        for seg_id in segment_ids:
+            if seg_id not in seen:
+                seen.add(seg_id)
+                unique_ids.append(seg_id)
+    return [unique_ids[i:i + max_ids] for i in range(0, len(unique_ids), max_ids)]
+
+
+def split_batch_results(segment_ids, batches, batch_results):
+    """
+    從合併批次的回應中取出單一查詢所需路段的車格，格式與單獨查詢 TDX 的回應相同；
+    該查詢的路段所在批次失敗時，返回只含這些路段的錯誤結果。
+    """
+    wanted = set(segment_ids)
+    spots = []
+    for batch_ids, data in zip(batches, batch_results):
+        if wanted.isdisjoint(batch_ids):
+            continue
+        if "error" in data:
+            error = dict(data)
+            error["api_responses"] = {seg_id: response for seg_id, response in data.get("api_responses", {}).items()
+                                      if seg_id in wanted}
+            return error
+        # 缺少 ParkingSegmentID 的車格交給每個查詢各自的欄位檢查處理
+        spots.extend(spot for spot in data.get("CurbSpotParkingAvailabilities", [])
+                     if "ParkingSegmentID" not in spot or spot["ParkingSegmentID"] in wanted)
+    return {"CurbSpotParkingAvailabilities": spots}
+
+
+def count_batch_calls(segment_ids, batches, batch_results):
+    """單一查詢用到的成功批次的呼叫數（分頁查詢時一批多次）；合併批次的呼叫數依此分別計入每個參與的查詢與用戶。"""
+    wanted = set(segment_ids)
+    return sum(data.get("calls", 1) for batch_ids, data in zip(batches, batch_results)
+               if "error" not in data and not wanted.isdisjoint(batch_ids))
+
+
+def users_by_batch(batches, waiting):
+    """每個批次服務的用戶（路段與批次重疊的呼叫者），供公平排程依這些用戶排序共用批次。"""
+    return [[user_id for segment_ids, user_id, _ in waiting if not set(batch_ids).isdisjoint(segment_ids)]
+            for batch_ids in batches]
+
+
+def _share(segment_ids, batches, batch_results):
+    return (split_batch_results(segment_ids, batches, batch_results),
+            count_batch_calls(segment_ids, batches, batch_results))
+
+
+class SpotBatchPlanner:
+    """
+    動態車格查詢的合併器：第一個查詢到達後等待 window 秒，期間所有查詢與監控需要的路段
+    （同一城市）合併成最少的 20 ID 批次一起送出，再把回應依路段分回各個呼叫者。
+
+    fetch 供同步查詢（Flask 執行緒、SSE 輪詢）使用，fetch_async 供同一事件迴圈中的監控使用；
+    兩者的批次統計共用，可由 fill_ratio() 與 summary() 查看批次填充率。
+
+    合併批次由第一個到達的呼叫者（或獨立任務）送出，不計入任何一個查詢；送出時一併傳入各批次
+    服務的用戶（取自各呼叫者的 current_user），供公平排程排序。每個呼叫者取得 (結果, 用到的批次數)，
+    自行計入自己的查詢與用戶。
+    """
+
+    def __init__(self, window=SPOT_BATCH_WINDOW_MS / 1000, max_ids=MAX_SEGMENT_IDS):
+        self.window = window
+        self.max_ids = max_ids
+        self.flushes = 0
+        self.demands = 0
+        self.batches = 0
+        self.ids_requested = 0
+        self.ids_fetched = 0
+        self._pending = {}
+        # asyncio Future 綁定事件迴圈，依迴圈各自合併
+        self._async_pending = weakref.WeakKeyDictionary()
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def fill_ratio(self):
+        """送出的批次中實際使用的 ID 比例（1.0 表示每批都填滿 max_ids 個）。"""
+        with self._lock:
+            return self.ids_fetched / (self.batches * self.max_ids) if self.batches else 0.0
+
+    def summary(self):
+        with self._lock:
+            flushes, demands, batches = self.flushes, self.demands, self.batches
+            ids_requested, ids_fetched = self.ids_requested, self.ids_fetched
+        return "合併 {} 次、{} 個查詢，送出 {} 批、{} 個路段 ID（查詢共需 {} 個），批次填充率 {:.0%}".format(
+            flushes, demands, batches, ids_fetched, ids_requested, self.fill_ratio())
+
+    def _plan(self, city, demands):
+        batches = plan_batches(demands, self.max_ids)
+        ids_fetched = sum(len(batch_ids) for batch_ids in batches)
+        with self._lock:
+            self.flushes += 1
+            self.demands += len(demands)
+            self.batches += len(batches)
+            self.ids_requested += sum(len(segment_ids) for segment_ids in demands)
+            self.ids_fetched += ids_fetched
+        if batches:
+            logger.info("合併 {} 個動態車格查詢（{}）為 {} 批、{} 個路段 ID，批次填充率 {:.0%}".format(
+                len(demands), city, len(batches), ids_fetched, ids_fetched / (len(batches) * self.max_ids)))
+        return batches
+
+    def fetch(self, city, segment_ids, fetch_batch):
+        """
+        同步查詢 segment_ids 的動態車格，與 window 內其他執行緒的查詢合併。
+
+        Args:
+            city (str): 城市代碼，只有同城市的查詢會合併
+            segment_ids (list): 此查詢需要的路段 ID
+            fetch_batch (callable): fetch_batch(batch_ids, user_ids) 查詢一批路段，返回 TDX 回應或錯誤結果（含 "error"）；
+                user_ids 為此批次服務的用戶，由等待期間第一個到達的查詢負責送出
+
+        Returns:
+            tuple: (只含 segment_ids 車格的 TDX 回應或錯誤結果, 此查詢用到的成功批次數)
+        """
+        user_id = current_user.get()
+        if self.window <= 0:
+            batches = self._plan(city, [segment_ids])
+            return _share(segment_ids, batches, [fetch_batch(batch_ids, [user_id]) for batch_ids in batches])
+
+        future = Future()
+        with self._lock:
+            waiting = self._pending.setdefault(city, [])
+            waiting.append((segment_ids, user_id, future))
+            leader = len(waiting) == 1
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                waiting = self._pending.pop(city)
+            try:
+                batches = self._plan(city, [ids for ids, _, _ in waiting])
+                batch_results = [fetch_batch(batch_ids, user_ids)
+                                 for batch_ids, user_ids in zip(batches, users_by_batch(batches, waiting))]
+            except Exception as e:
+                for _, _, waiter in waiting:
+                    waiter.set_exception(e)
+            else:
+                for ids, _, waiter in waiting:
+                    waiter.set_result(_share(ids, batches, batch_results))
+        return future.result()
+
+    async def fetch_async(self, city, segment_ids, fetch_batches):
+        """
+        fetch 的非同步版本。
+
+        fetch_batches(batches, batch_users) 為 coroutine function，並行送出所有批次並依序返回結果，batch_users
+        為各批次服務的用戶；合併後的批次由獨立任務呼叫，實作需自行建立 HTTP client，不可使用任一呼叫者的
+        client（呼叫者可能先被取消）。
+        """
+        user_id = current_user.get()
+        if self.window <= 0:
+            batches = self._plan(city, [segment_ids])
+            return _share(segment_ids, batches, await fetch_batches(batches, [[user_id]] * len(batches)))
+
+        loop = asyncio.get_running_loop()
+        pending = self._async_pending.setdefault(loop, {})
+        future = loop.create_future()
+        waiting = pending.setdefault(city, [])
+        waiting.append((segment_ids, user_id, future))
+        if len(waiting) == 1:
+            # 以獨立任務送出，第一個呼叫者被取消時仍會完成並回應其他呼叫者
+            task = loop.create_task(self._flush_async(pending, city, fetch_batches))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await future
+
+    async def _flush_async(self, pending, city, fetch_batches):
+        await asyncio.sleep(self.window)
+        waiting = pending.pop(city)
+        try:
+            batches = self._plan(city, [ids for ids, _, _ in waiting])
+            batch_results = await fetch_batches(batches, users_by_batch(batches, waiting))
+        except Exception as e:
+            for _, _, waiter in waiting:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for ids, _, waiter in waiting:
+                if not waiter.done():
+                    waiter.set_result(_share(ids, batches, batch_results))
@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+import threading
+import httpx
+import requests
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 斷路器參數：連續失敗幾次後開路、開路後多久允許探測
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", default=3))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", default=30))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """斷路器開路中，直接拒絕呼叫上游，不等待逾時。"""
+
+
+class CircuitBreaker:
+    """
+    單一 TDX 端點的斷路器。
+
+    closed：正常呼叫；連續失敗達門檻後轉為 open。
+    open：直接拒絕呼叫，經過 reset_timeout 後轉為 half_open。
+    half_open：只放行一次探測呼叫，成功則 closed，失敗則重新 open。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                logger.info("斷路器 {} 進入半開狀態，放行探測呼叫".format(self.name))
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_after(self):
+        """距離允許下一次探測還需等待的秒數（未開路時為 0）。"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.reset_timeout - (time.time() - self.opened_at))
+
+    def is_closed(self):
+        with self._lock:
+            return self.state == self.CLOSED
+
+    def is_available(self):
+        """呼叫此端點是否可能被放行：closed，或 open 已超過 reset_timeout、下一次呼叫即為探測。"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.time() - self.opened_at >= self.reset_timeout
+            return not self._probe_in_flight
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("斷路器 {} 恢復正常（closed）".format(self.name))
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """呼叫未完成就中止（例如被取消）時釋放半開狀態的探測名額，不改變斷路器狀態。"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("斷路器 {} 開路，連續失敗 {} 次，{} 秒內快速失敗".format(
+                        self.name, self.consecutive_failures, self.reset_timeout))
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def is_upstream_failure(exc):
+    """判斷例外是否代表上游不健康（逾時、連線失敗或 5xx），429/4xx 不計入斷路器。requests 與 httpx 皆適用。"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        return exc.response is not None and exc.response.status_code >= 500
+    return isinstance(exc, (requests.exceptions.RequestException, httpx.HTTPError))
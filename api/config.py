@@ -1,5 +1,14 @@
+import os
 from itertools import chain
 
+# TDX API 端點與每次 OData in (...) 過濾最多可帶的路段 ID 數
+SEGMENT_URL = "https://tdx.transportdata.tw/api/basic/v1/Parking/OnStreet/ParkingSegment/City/{}"
+SPOT_URL = "https://tdx.transportdata.tw/api/basic/v1/Parking/OnStreet/ParkingSpotAvailability/City/{}"
+MAX_SEGMENT_IDS = 20
+# 動態車格查詢每頁的 $top；回應筆數等於 $top 時以 $skip 查詢下一頁，最多 SPOT_MAX_PAGES 頁
+SPOT_PAGE_SIZE = int(os.getenv("SPOT_PAGE_SIZE", default=1000))
+SPOT_MAX_PAGES = int(os.getenv("SPOT_MAX_PAGES", default=10))
+
 address_to_segment = {
     "明德路337巷": [{"id": "1124337", "name": "明德路337巷"}],
     "明德路": [{"id": "1124000", "name": "明德路"}],
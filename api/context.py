@@ -0,0 +1,99 @@
+import time
+import threading
+from collections import deque
+
+# TDX 每分鐘取得 Access Token 的次數上限
+TOKEN_RATE_LIMIT = 20
+
+
+class QueryContext:
+    """
+    單次查詢的上下文，取代以往存在共用 ParkingFinder 上、每次查詢重置的計數。
+
+    address、spot_number、user_id 與 started_at 建立後不可修改；同一查詢中並行的批次以
+    count_call() 累計 API 呼叫數（合併批次依此查詢用到的批次數計入），不同執行緒或任務的查詢各自獨立。
+    """
+
+    __slots__ = ("address", "spot_number", "user_id", "started_at", "_api_calls", "_lock")
+
+    def __init__(self, address=None, spot_number=None, user_id=None):
+        for name, value in (("address", address), ("spot_number", spot_number), ("user_id", user_id),
+                            ("started_at", time.time()), ("_api_calls", 0), ("_lock", threading.Lock())):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("QueryContext 建立後不可修改: {}".format(name))
+
+    def count_call(self, calls=1):
+        with self._lock:
+            object.__setattr__(self, "_api_calls", self._api_calls + calls)
+
+    @property
+    def api_calls(self):
+        with self._lock:
+            return self._api_calls
+
+
+class TokenCache:
+    """
+    多個執行緒與事件迴圈共用的 TDX Access Token。
+
+    同步查詢取得新 Token 時先持有 refresh_lock，同時到期的執行緒只會送出一次請求；
+    最近一分鐘的取得次數用來避開 TDX 每分鐘 20 次的限制。
+    """
+
+    def __init__(self, rate_limit=TOKEN_RATE_LIMIT):
+        self.rate_limit = rate_limit
+        self.refresh_lock = threading.Lock()
+        self._token = None
+        self._expiry = 0
+        self._requests = deque()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """返回仍有效的 Token，即將到期或尚未取得時返回 None。"""
+        with self._lock:
+            if self._token and time.time() < self._expiry - 60:
+                return self._token
+            return None
+
+    def store(self, token, expires_in, issued_at):
+        with self._lock:
+            self._token = token
+            self._expiry = issued_at + expires_in - 60
+
+    def record_request(self, now=None):
+        """記錄一次取得 Token 的請求，返回送出前應等待的秒數（最近一分鐘已達上限時大於 0）。"""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._requests and self._requests[0] <= now - 60:
+                self._requests.popleft()
+            wait = self._requests[0] + 60 - now if len(self._requests) >= self.rate_limit else 0
+            self._requests.append(now + wait)
+            return wait
+
+
+class SegmentNameCache:
+    """路段 ID 對應名稱的共用快取，讀寫皆持有鎖。"""
+
+    def __init__(self):
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, seg_id):
+        with self._lock:
+            return seg_id in self._names
+
+    def get(self, seg_id, default=None):
+        with self._lock:
+            return self._names.get(seg_id, default)
+
+    def set(self, seg_id, name):
+        with self._lock:
+            self._names[seg_id] = name
+
+    def lookup(self, segment_ids):
+        """返回 (已快取的 {路段 ID: 名稱}, 未快取的路段 ID 列表)。"""
+        with self._lock:
+            names = {seg_id: self._names[seg_id] for seg_id in segment_ids if seg_id in self._names}
+        return names, [seg_id for seg_id in segment_ids if seg_id not in names]
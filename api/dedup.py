@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import functools
+from contextlib import closing
+from collections import OrderedDict
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 已處理事件的保留秒數與最大筆數；設定 EVENT_DEDUP_DB 時以 SQLite 檔案在多個 worker 間共用
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", default=600))
+EVENT_DEDUP_MAX = int(os.getenv("EVENT_DEDUP_MAX", default=10000))
+EVENT_DEDUP_DB = os.getenv("EVENT_DEDUP_DB")
+
+
+class EventDeduplicator:
+    """
+    以 webhook_event_id 判斷 LINE 重送的事件，確保同一事件只處理一次。
+
+    記憶體中保留有上限、依 TTL 淘汰的已處理集合；若指定 db_path，則改以 SQLite 檔案
+    記錄，讓同一台機器上的多個 worker 共用。
+    """
+
+    def __init__(self, ttl=EVENT_DEDUP_TTL, max_size=EVENT_DEDUP_MAX, db_path=EVENT_DEDUP_DB):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.db_path = db_path
+        self.duplicate_count = 0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        if self.db_path:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=1, isolation_level="IMMEDIATE")
+
+    def claim(self, event_id):
+        """首次看到事件時記錄並返回 True；已在保留期內處理過則返回 False。"""
+        if not event_id:
+            return True
+        now = time.time()
+        if self.db_path:
+            claimed = self._claim_shared(event_id, now)
+        else:
+            claimed = self._claim_local(event_id, now)
+        if not claimed:
+            with self._lock:
+                self.duplicate_count += 1
+        return claimed
+
+    def _claim_local(self, event_id, now):
+        with self._lock:
+            # OrderedDict 依寫入順序排列，過期項目必在最前面
+            while self._seen and next(iter(self._seen.values())) <= now:
+                self._seen.popitem(last=False)
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now + self.ttl
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def _claim_shared(self, event_id, now):
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM seen_events WHERE expires_at <= ?", (now,))
+                cursor = conn.execute("INSERT OR IGNORE INTO seen_events (event_id, expires_at) VALUES (?, ?)",
+                                      (event_id, now + self.ttl))
+                conn.execute(
+                    "DELETE FROM seen_events WHERE event_id IN "
+                    "(SELECT event_id FROM seen_events ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,))
+                return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            # 共用儲存異常時退回單一 worker 的記憶體集合，避免因此拒絕處理事件
+            logger.error("事件去重資料庫錯誤，改用記憶體集合: {}".format(str(e)))
+            return self._claim_local(event_id, now)
+
+    def release(self, event_id):
+        """事件處理失敗時移除記錄，讓 LINE 重送時能重新處理。"""
+        if not event_id:
+            return
+        with self._lock:
+            self._seen.pop(event_id, None)
+        if self.db_path:
+            try:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute("DELETE FROM seen_events WHERE event_id = ?", (event_id,))
+            except sqlite3.Error as e:
+                logger.error("事件去重資料庫錯誤: {}".format(str(e)))
+
+    def deduplicate(self, func):
+        """裝飾 LINE 事件處理函式：重送的事件直接略過，不再執行處理函式。"""
+        @functools.wraps(func)
+        def wrapper(event):
+            event_id = getattr(event, "webhook_event_id", None)
+            if not self.claim(event_id):
+                delivery_context = getattr(event, "delivery_context", None)
+                logger.info("略過重複的 webhook 事件: {}，重送: {}".format(
+                    event_id, getattr(delivery_context, "is_redelivery", None)))
+                return None
+            try:
+                return func(event)
+            except Exception:
+                self.release(event_id)
+                raise
+        return wrapper
@@ -0,0 +1,318 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 所有用戶同時對 TDX 發出的請求上限，超過時依公平排程排隊
+FAIR_MAX_CONCURRENCY = int(os.getenv("FAIR_MAX_CONCURRENCY", default=4))
+# 每位用戶在 USER_QUOTA_WINDOW 秒內可使用的 TDX 呼叫數，超過時改回應快取結果
+USER_TDX_QUOTA = int(os.getenv("USER_TDX_QUOTA", default=60))
+USER_QUOTA_WINDOW = float(os.getenv("USER_QUOTA_WINDOW", default=600))
+# 每位用戶同時進行的監控數上限
+USER_MAX_MONITORS = int(os.getenv("USER_MAX_MONITORS", default=2))
+# 每隔幾秒清除一次閒置用戶（近期沒有呼叫、沒有監控、未排隊）的統計，避免每個 IP 都留下一筆
+FAIR_PRUNE_INTERVAL = float(os.getenv("FAIR_PRUNE_INTERVAL", default=60))
+# 個別用戶的排程權重，例如 "Uxxxx:2,Uyyyy:0.5"（未列出者為 1）
+USER_WEIGHTS = os.getenv("USER_WEIGHTS", default="")
+
+# 背景重新查詢、預熱、SSE 輪詢等沒有特定用戶的呼叫
+SYSTEM_USER = "system"
+
+# 目前這次查詢要計入的用戶；執行緒與 asyncio 任務各自獨立，asyncio.run 會沿用呼叫端的值
+current_user = contextvars.ContextVar("tdx_user", default=None)
+# 以 SYSTEM_USER 送出的共用請求（合併後的動態車格批次）所服務的用戶
+shared_users = contextvars.ContextVar("tdx_shared_users", default=())
+
+
+def parse_weights(text):
+    weights = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        user_id, _, weight = item.rpartition(":")
+        try:
+            weights[user_id] = float(weight)
+        except ValueError:
+            logger.warning("USER_WEIGHTS 格式無效，略過: {}".format(item))
+    return weights
+
+
+def charge_to_event_user(func):
+    """裝飾 LINE 事件處理函式，讓其中的 TDX 呼叫計入發送訊息的用戶。"""
+    @functools.wraps(func)
+    def wrapper(event, *args, **kwargs):
+        token = current_user.set(getattr(event.source, "user_id", None))
+        try:
+            return func(event, *args, **kwargs)
+        finally:
+            current_user.reset(token)
+    return wrapper
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Waiter:
+    def __init__(self, user_id, wake):
+        self.user_id = user_id
+        self.wake = wake
+        self.enqueued_at = time.time()
+        self.granted = False
+        self.cancelled = False
+
+
+class UserUsage:
+    """單一用戶的 TDX 使用統計。"""
+
+    def __init__(self):
+        self.recent_calls = deque()
+        self.total_calls = 0
+        self.monitors = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.degraded = 0
+
+    def prune(self, now, window):
+        while self.recent_calls and self.recent_calls[0] <= now - window:
+            self.recent_calls.popleft()
+
+
+class FairScheduler:
+    """
+    所有 TDX 請求前的加權公平排程與每位用戶的用量統計。
+
+    同時進行的請求超過 max_concurrency 時，等待中的請求依 start-time fair queueing 排序：
+    每位用戶的每次請求依權重累加虛擬時間，最近用量越多的用戶排得越後面，少量使用的用戶
+    不會被大量查詢或監控的用戶拖慢。呼叫者所屬用戶取自 current_user。
+
+    多位用戶共用的請求（for_users 區塊內）以參與用戶中最早的虛擬時間排序，不推進任何人的虛擬時間；
+    送出後由 charge 依實際呼叫數推進各參與用戶的虛擬時間。
+
+    近 quota_window 秒內沒有呼叫、沒有監控也沒有排隊中請求的用戶，每 prune_interval 秒清除一次
+    （包含其虛擬時間），統計只保留仍在使用的用戶。
+    """
+
+    def __init__(self, max_concurrency=FAIR_MAX_CONCURRENCY, quota=USER_TDX_QUOTA, quota_window=USER_QUOTA_WINDOW,
+                 max_monitors=USER_MAX_MONITORS, weights=None, prune_interval=FAIR_PRUNE_INTERVAL):
+        self.max_concurrency = max_concurrency
+        self.quota = quota
+        self.quota_window = quota_window
+        self.max_monitors = max_monitors
+        self.weights = parse_weights(USER_WEIGHTS) if weights is None else weights
+        self.prune_interval = prune_interval
+        self.users = {}
+        self._queue = []
+        self._active = 0
+        self._virtual_time = 0.0
+        self._finish_tags = {}
+        self._seq = itertools.count()
+        self._last_prune = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def as_user(self, user_id):
+        """區塊內的 TDX 呼叫計入 user_id。"""
+        token = current_user.set(user_id)
+        try:
+            yield
+        finally:
+            current_user.reset(token)
+
+    @contextmanager
+    def for_users(self, user_ids):
+        """區塊內的 TDX 呼叫為 user_ids 共用的請求：呼叫數計入 SYSTEM_USER，排序依參與用戶的虛擬時間。"""
+        user_token = current_user.set(SYSTEM_USER)
+        shared_token = shared_users.set(tuple(user_id or SYSTEM_USER for user_id in user_ids))
+        try:
+            yield
+        finally:
+            shared_users.reset(shared_token)
+            current_user.reset(user_token)
+
+    def _start_tag(self, user_id):
+        return max(self._virtual_time, self._finish_tags.get(user_id, 0.0))
+
+    def _usage(self, user_id):
+        if user_id not in self.users:
+            self.users[user_id] = UserUsage()
+        return self.users[user_id]
+
+    def _prune_idle(self, now):
+        """清除閒置用戶的統計與虛擬時間；需持有 _lock。"""
+        if now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        queued_users = {waiter.user_id for _, _, waiter in self._queue if not waiter.cancelled}
+        for user_id in list(self.users):
+            usage = self.users[user_id]
+            usage.prune(now, self.quota_window)
+            if not usage.recent_calls and not usage.monitors and user_id not in queued_users:
+                # 閒置超過 quota_window 的用戶不再承擔先前用量造成的排序延後
+                del self.users[user_id]
+                self._finish_tags.pop(user_id, None)
+
+    def _enqueue(self, wake):
+        """登記一次請求；可立即執行時返回 None，否則返回排隊中的 _Waiter，輪到時呼叫 wake()。"""
+        user_id = current_user.get() or SYSTEM_USER
+        participants = shared_users.get()
+        now = time.time()
+        with self._lock:
+            self._prune_idle(now)
+            usage = self._usage(user_id)
+            usage.prune(now, self.quota_window)
+            usage.recent_calls.append(now)
+            usage.total_calls += 1
+            if participants:
+                start_tag = min(self._start_tag(participant) for participant in participants)
+            else:
+                start_tag = self._start_tag(user_id)
+                self._finish_tags[user_id] = start_tag + 1.0 / self.weights.get(user_id, 1.0)
+            if self._active < self.max_concurrency and not self._queue:
+                self._active += 1
+                self._virtual_time = start_tag
+                return None
+            waiter = _Waiter(user_id, wake)
+            heapq.heappush(self._queue, (start_tag, next(self._seq), waiter))
+            usage.queued += 1
+            return waiter
+
+    def _release(self):
+        """釋放一個執行名額，交給虛擬時間最小的等待請求。"""
+        with self._lock:
+            while self._queue:
+                start_tag, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._virtual_time = start_tag
+                self._usage(waiter.user_id).wait_time += time.time() - waiter.enqueued_at
+                break
+            else:
+                self._active -= 1
+                return
+        waiter.wake()
+
+    @contextmanager
+    def slot(self):
+        """同步呼叫 TDX 前取得執行名額，名額不足時阻塞排隊。"""
+        event = threading.Event()
+        if self._enqueue(event.set) is not None:
+            event.wait()
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """slot 的非同步版本，排隊時不阻塞事件迴圈。"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enqueue(lambda: loop.call_soon_threadsafe(_resolve, future))
+        if waiter is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    waiter.cancelled = True
+                    granted = waiter.granted
+                # 已輪到但被取消，把名額交給下一個
+                if granted:
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def charge(self, calls, user_id=None):
+        """
+        將以 SYSTEM_USER 送出的共用請求（合併後的動態車格批次）計入參與的用戶：
+        增加近期與總呼叫數，並推進其虛擬時間，之後的請求與配額檢查都會反映這些用量。
+        """
+        if calls <= 0:
+            return
+        user_id = user_id or current_user.get() or SYSTEM_USER
+        now = time.time()
+        with self._lock:
+            usage = self._usage(user_id)
+            usage.prune(now, self.quota_window)
+            usage.recent_calls.extend([now] * calls)
+            usage.total_calls += calls
+            self._finish_tags[user_id] = self._start_tag(user_id) + calls / self.weights.get(user_id, 1.0)
+
+    def over_quota(self, user_id=None):
+        """用戶在 quota_window 秒內的 TDX 呼叫數是否已達上限（系統呼叫不受限）。"""
+        user_id = user_id or current_user.get()
+        if not user_id or user_id == SYSTEM_USER:
+            return False
+        with self._lock:
+            usage = self.users.get(user_id)
+            if usage is None:
+                return False
+            usage.prune(time.time(), self.quota_window)
+            return len(usage.recent_calls) >= self.quota
+
+    def retry_after(self, user_id=None):
+        """用戶恢復配額還需等待的秒數。"""
+        user_id = user_id or current_user.get()
+        with self._lock:
+            usage = self.users.get(user_id)
+            if usage is None or len(usage.recent_calls) < self.quota:
+                return 0
+            return max(0, usage.recent_calls[-self.quota] + self.quota_window - time.time())
+
+    def record_degraded(self, user_id=None):
+        with self._lock:
+            self._usage(user_id or current_user.get() or SYSTEM_USER).degraded += 1
+
+    def start_monitor(self, user_id):
+        """登記一個監控；已達 max_monitors 時返回 False。"""
+        with self._lock:
+            usage = self._usage(user_id)
+            if usage.monitors >= self.max_monitors:
+                return False
+            usage.monitors += 1
+            return True
+
+    def end_monitor(self, user_id):
+        with self._lock:
+            usage = self._usage(user_id)
+            usage.monitors = max(0, usage.monitors - 1)
+
+    def snapshot(self):
+        """各用戶用量，依近期呼叫數由多到少排序。"""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for user_id, usage in self.users.items():
+                usage.prune(now, self.quota_window)
+                rows.append({
+                    "user_id": user_id,
+                    "recent_calls": len(usage.recent_calls),
+                    "total_calls": usage.total_calls,
+                    "monitors": usage.monitors,
+                    "queued": usage.queued,
+                    "avg_wait": usage.wait_time / usage.queued if usage.queued else 0.0,
+                    "degraded": usage.degraded
+                })
+        return sorted(rows, key=lambda row: row["recent_calls"], reverse=True)
+
+    def summary(self, limit=20):
+        lines = ["TDX 用量（近 {:.0f} 分鐘上限 {} 次）：".format(self.quota_window / 60, self.quota)]
+        for row in self.snapshot()[:limit]:
+            lines.append("{}：近期 {} 次，總計 {} 次，監控 {} 個，排隊 {} 次（平均 {:.2f} 秒），快取回應 {} 次".format(
+                row["user_id"], row["recent_calls"], row["total_calls"], row["monitors"], row["queued"],
+                row["avg_wait"], row["degraded"]))
+        return "\n".join(lines)
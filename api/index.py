@@ -1,6 +1,8 @@
 import os
+import re
 import logging
 import json
+import hashlib
 import asyncio  # 導入 asyncio 用於非同步監控
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
@@ -8,6 +10,12 @@ from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from api.chatgpt import ChatGPT
 from api.parking import ParkingFinder
+from api.config import address_to_segment
+from api.dedup import EventDeduplicator
+from api.profiling import profiler
+from api.stream import SpotChangeHub
+from api.prefetch import UsageTracker, Prefetcher, KVUsageStore, PREFETCH_HEADER
+from api.fairness import charge_to_event_user
 
 # 設置日誌記錄，方便除錯
 logging.basicConfig(level=logging.INFO)
@@ -17,9 +25,21 @@ logger = logging.getLogger(__name__)
 line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
 line_handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 working_status = os.getenv("DEFAULT_TALKING", default="true").lower() == "true"
+# 可使用管理指令（如「效能分析」）的 LINE 用戶 ID，以逗號分隔
+admin_user_ids = set(filter(None, os.getenv("ADMIN_USER_IDS", default="").split(",")))
+# JSON 車位 API 的快取秒數：期間內重用上次結果，瀏覽器與 CDN 也依此快取
+PARKING_API_MAX_AGE = int(os.getenv("PARKING_API_MAX_AGE", default=15))
+# 快取過期後 CDN 仍可先回應舊結果、同時在背景更新的秒數（應涵蓋預熱排程的間隔）
+PARKING_API_STALE_WHILE_REVALIDATE = int(os.getenv("PARKING_API_STALE_WHILE_REVALIDATE", default=60))
+# 排程預熱路由的驗證金鑰（Vercel Cron 會帶上 Authorization: Bearer <CRON_SECRET>）
+CRON_SECRET = os.getenv("CRON_SECRET")
 app = Flask(__name__)
 chatgpt = ChatGPT()
 parking_finder = ParkingFinder()
+event_deduplicator = EventDeduplicator()
+spot_change_hub = SpotChangeHub(parking_finder, max_age=PARKING_API_MAX_AGE)
+usage_tracker = UsageTracker(store=KVUsageStore.from_env())
+prefetcher = Prefetcher(parking_finder, usage_tracker)
 
 @app.route('/')
 def home():
@@ -43,7 +63,89 @@ def callback():
         abort(500)
     return 'OK'
 
+def json_error(alias, errors, status):
+    # 用戶端錯誤（400/404）的結果不會改變，可讓瀏覽器與 CDN 快取；上游錯誤（502）不快取
+    body = json.dumps({"address": alias, "errors": errors}, ensure_ascii=False, separators=(",", ":"))
+    response = app.response_class(body, status=status, mimetype="application/json")
+    response.headers["Cache-Control"] = "no-store" if status >= 500 else "public, max-age=3600"
+    return response
+
+def unknown_alias_response(alias):
+    # 只接受 address_to_segment 中的固定地址，任意文字不會觸發 TDX 模糊路段查詢
+    if parking_finder.is_alias(alias):
+        return None
+    return json_error(alias, ["未知的地址，可用地址：{}".format(", ".join(address_to_segment.keys()))], 404)
+
+@app.route("/api/parking/<alias>")
+def parking_api(alias):
+    # 提供看板與腳本輪詢的 JSON 車位資料，ETag 由各路段 DataCollectTime 產生，資料未更新時回 304
+    spot_number = request.args.get("spot")
+    if spot_number is not None and not re.fullmatch(r"[0-9A-Za-z]{1,10}", spot_number):
+        return json_error(alias, ["車格號格式無效，僅接受英數字（例如 spot=112）"], 400)
+    error_response = unknown_alias_response(alias)
+    if error_response is not None:
+        return error_response
+    # 預熱請求不算用戶查詢
+    if not request.headers.get(PREFETCH_HEADER):
+        usage_tracker.record(alias)
+    try:
+        # 依來源 IP 計入 TDX 用量與公平排程
+        with parking_finder.fair_scheduler.as_user("ip:{}".format(request.remote_addr)):
+            data = parking_finder.find_grouped_parking_data(alias, spot_number, max_age=PARKING_API_MAX_AGE)
+    except Exception as e:
+        logger.error("車位 API 錯誤: {}".format(str(e)))
+        data = {"ok": False, "error_msgs": [str(e)]}
+    if not data["ok"]:
+        # 地址已驗證，此時查詢失敗代表 TDX 異常
+        return json_error(alias, data["error_msgs"], 502)
+
+    etag = hashlib.sha1(json.dumps([alias, spot_number, sorted(data["collect_times"].items())]).encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        body = json.dumps({
+            "address": alias,
+            "segments": data["segments"],
+            "collect_times": data["collect_times"],
+            "stale_age": data["stale_age"],
+            "errors": data["error_msgs"]
+        }, ensure_ascii=False, separators=(",", ":"))
+        response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "public, max-age={0}, s-maxage={0}, stale-while-revalidate={1}".format(
+        PARKING_API_MAX_AGE, PARKING_API_STALE_WHILE_REVALIDATE)
+    return response
+
+@app.route("/api/warmup")
+def warmup():
+    # 由 Vercel Cron（vercel.json）觸發：依查詢統計與 PREFETCH_ADDRESSES 提前更新接下來可能被查詢的地址
+    if CRON_SECRET and request.headers.get("Authorization") != "Bearer {}".format(CRON_SECRET):
+        abort(401)
+    report = prefetcher.warm()
+    return app.response_class(json.dumps(report, ensure_ascii=False), mimetype="application/json")
+
+@app.route("/api/parking/<alias>/stream")
+def parking_stream(alias):
+    # 以 Server-Sent Events 推送車格空出（free）/占用（occupied）事件，所有連線共用同一個上游輪詢
+    segment_id = request.args.get("segment")
+    error_response = unknown_alias_response(alias)
+    if error_response is not None:
+        return error_response
+
+    def generate():
+        # 開始傳送時才訂閱，連線關閉時 events() 會自動取消訂閱
+        subscription = spot_change_hub.subscribe(alias, segment_id)
+        yield from subscription.events()
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 @line_handler.add(MessageEvent, message=TextMessage)
+@event_deduplicator.deduplicate  # LINE 重送的事件直接回 OK，不重複查詢 TDX 或 OpenAI
+@charge_to_event_user  # 處理過程中的 TDX 呼叫計入發送訊息的用戶
+@profiler.profile("handle_message")
 def handle_message(event):
     # 處理 LINE 文字訊息
     global working_status
@@ -62,6 +164,27 @@ def handle_message(event):
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="感謝使用，請說「啟動」重新開啟~"))
         return
 
+    if message_text.startswith("效能分析") and user_id in admin_user_ids:
+        # 管理指令：效能分析 0.1（設定抽樣比例）、效能分析 關閉、效能分析（查看狀態與最近一次結果）
+        arg = message_text[4:].strip()
+        if arg == "關閉":
+            profiler.set_sample_rate(0)
+        elif arg:
+            try:
+                profiler.set_sample_rate(float(arg))
+            except ValueError:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請提供 0 到 1 的抽樣比例，例如：效能分析 0.1"))
+                return
+        status_text = "效能分析抽樣比例：{}\n動態車格批次：{}\n{}".format(
+            profiler.sample_rate, parking_finder.spot_planner.summary(), profiler.last_summary or "尚無分析結果")
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=status_text[:5000]))
+        return
+
+    if message_text == "用量" and user_id in admin_user_ids:
+        # 管理指令：查看各用戶的 TDX 用量、監控數與排隊情形
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=parking_finder.fair_scheduler.summary()[:5000]))
+        return
+
     if message_text.startswith("停車"):
         # 處理停車查詢指令
         address = message_text[2:].strip()
@@ -69,8 +192,8 @@ def handle_message(event):
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請提供路段地址，例如：停車 明德路337巷"))
             return
         try:
-            # 調用 ParkingFinder 查詢分組車位
-            response_text, error_msgs, api_responses, _ = parking_finder.find_grouped_parking_spots(address)
+            # 調用 ParkingFinder 查詢分組車位（經由 Prefetcher 記錄查詢，預熱過的地址直接使用預熱資料）
+            response_text, error_msgs, api_responses, _ = prefetcher.find_grouped_parking_spots(address)
             # 分段發送訊息
             MAX_LINE_MESSAGE_LENGTH = 5000
             messages = []
@@ -105,6 +228,7 @@ def handle_message(event):
         if not address:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請提供路段地址，例如：監控停車 青年公園"))
             return
+        usage_tracker.record(address)
         try:
             # 啟動監控任務（非同步）
             asyncio.run(parking_finder.monitor_parking_spots(address, user_id, max_duration=60))
@@ -126,4 +250,4 @@ def handle_message(event):
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="AI回應失敗，請稍後再試！"))
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,176 @@
+import json
+import re
+import codecs
+from json.scanner import make_scanner
+
+# 元素之間的空白與逗號
+_SEPARATOR = re.compile(r"[\s,]*")
+_WHITESPACE = re.compile(r"\s*")
+# 物件元素的結尾：之後是逗號與下一個物件，或是陣列結束
+_ITEM_END = re.compile(r"\s*(?:,\s*\{|\])")
+
+
+class ArrayItemDecoder:
+    """
+    從分段到達的 JSON 回應中逐一解析最外層物件裡指定 key 的陣列元素。
+
+    每收到一段資料（已解壓縮的 bytes）就返回其中完整的元素，不需等整份回應下載完，
+    也不會建立整份回應的 dict。每段資料中已完整的元素一次交給 json 的 C scanner 解析，
+    未解析的部分只在最後移到新的緩衝區一次，整體速度與對整份回應呼叫 json.loads 相當。
+    key 之前的其他欄位整個略過，只有最外層物件的欄位名稱會比對 key，巢狀物件中或字串值中
+    出現的同名 key 不影響結果。元素不可為單獨的數字（TDX 回應皆為物件陣列）。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.found = False
+        self._marker = json.dumps(key)
+        self._closed = False
+        self._scan = make_scanner(json.JSONDecoder())
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._state = "start"
+
+    def feed(self, chunk):
+        """加入一段資料，返回這段資料讓它變完整的陣列元素。"""
+        text = self._utf8.decode(chunk)
+        self._buffer = self._buffer + text if self._buffer else text
+        return self._parse()
+
+    def close(self):
+        """資料結束時呼叫，返回剩餘的元素；回應不是 JSON 物件或在陣列結束前中斷時拋出 ValueError。"""
+        self._buffer += self._utf8.decode(b"", final=True)
+        self._closed = True
+        items = self._parse()
+        if self._state == "start":
+            raise ValueError("回應不是 JSON 物件")
+        if self._state != "done":
+            if self.found:
+                raise ValueError("JSON 回應不完整，{} 陣列未結束".format(self.key))
+            raise ValueError("JSON 回應不完整")
+        return items
+
+    def _skip(self, pos):
+        return _WHITESPACE.match(self._buffer, pos).end()
+
+    def _member(self, pos):
+        """
+        解析最外層物件中從 pos 開始的一個欄位。
+
+        Returns:
+            tuple: (欄位之後的位置, 此欄位是否為 key)；資料還不足以判斷時返回 (None, False)
+        """
+        buffer = self._buffer
+        try:
+            name, pos = self._scan(buffer, pos)
+        except (json.JSONDecodeError, StopIteration):
+            return None, False
+        pos = self._skip(pos)
+        if pos >= len(buffer):
+            return None, False
+        if buffer[pos] != ":" or not isinstance(name, str):
+            raise ValueError("JSON 格式錯誤：欄位名稱之後應為 ':'")
+        if name == self.key:
+            return pos + 1, True
+        # 其他欄位的值（可能含有同名的 key 或字串）整個略過
+        try:
+            _, pos = self._scan(buffer, self._skip(pos + 1))
+        except (json.JSONDecodeError, StopIteration):
+            if self._closed:
+                raise ValueError("JSON 回應不完整")
+            return None, False
+        # 數字可能被切斷，需看到之後的字元才算完整
+        if pos >= len(buffer) and not self._closed:
+            return None, False
+        return pos, False
+
+    def _parse(self):
+        items = []
+        buffer = self._buffer
+        pos = self._skip(0)
+        if self._state == "start":
+            if pos >= len(buffer):
+                return items
+            if buffer[pos] != "{":
+                raise ValueError("回應不是 JSON 物件")
+            self._state = "member"
+            pos = self._skip(pos + 1)
+        while self._state in ("member", "next"):
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if char == "}":
+                # 最外層物件結束但沒有 key
+                self._state = "done"
+                break
+            if self._state == "next":
+                if char != ",":
+                    raise ValueError("JSON 格式錯誤：欄位之間應為 ','")
+                self._state = "member"
+                pos = self._skip(pos + 1)
+                continue
+            if char != '"':
+                raise ValueError("JSON 格式錯誤：應為欄位名稱")
+            end, is_key = self._member(pos)
+            if end is None:
+                # 欄位尚未完整，從欄位開頭保留到下一段資料
+                break
+            pos = self._skip(end)
+            if is_key:
+                self.found = True
+                self._state = "open"
+            else:
+                self._state = "next"
+        if self._state == "open" and pos < len(buffer):
+            if buffer[pos] != "[":
+                raise ValueError("JSON 格式錯誤：{} 之後應為 '['".format(self._marker))
+            self._state = "items"
+            pos += 1
+        if self._state == "items":
+            pos = self._parse_items(buffer, pos, items)
+        # 陣列結束後的其他欄位不需要
+        self._buffer = "" if self._state == "done" else buffer[pos:]
+        return items
+
+    def _parse_items(self, buffer, pos, items):
+        """從 pos 起解析完整的元素加入 items，返回第一個未解析的位置。"""
+        pos = _SEPARATOR.match(buffer, pos).end()
+        boundary = self._last_item_end(buffer, pos)
+        if boundary > pos:
+            # 最後一個完整元素之前的元素一次交給 C scanner 解析，速度與 json.loads 相同；
+            # 找到的結尾其實在字串或巢狀物件中時解析失敗，改為逐一解析
+            try:
+                batch, _ = self._scan("[" + buffer[pos:boundary] + "]", 0)
+            except (json.JSONDecodeError, StopIteration):
+                pass
+            else:
+                items.extend(batch)
+                pos = _SEPARATOR.match(buffer, boundary).end()
+                if not buffer.startswith("]", pos):
+                    # 之後只剩不完整的元素
+                    return pos
+        scan = self._scan
+        end = len(buffer)
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            if pos >= end:
+                return pos
+            if buffer[pos] == "]":
+                self._state = "done"
+                return pos + 1
+            try:
+                item, pos = scan(buffer, pos)
+            except (json.JSONDecodeError, StopIteration):
+                # 元素尚未完整，等下一段資料
+                return pos
+            items.append(item)
+
+    @staticmethod
+    def _last_item_end(buffer, pos):
+        """pos 之後最後一個看起來是元素結尾的 "}" 的下一個位置，找不到時返回 pos。"""
+        end = buffer.rfind("}", pos)
+        while end >= pos:
+            if _ITEM_END.match(buffer, end + 1):
+                return end + 1
+            end = buffer.rfind("}", pos, end)
+        return pos
@@ -4,11 +4,22 @@ import logging
 import json
 import re
 import time
+import threading
+from contextlib import closing
 import asyncio  # 導入 asyncio 用於非同步監控
 from datetime import datetime, timezone
 from linebot import LineBotApi
 from linebot.models import TextSendMessage  # 導入 TextSendMessage 用於 LINE 推送
-from api.config import address_to_segment, group_config
+from api.config import address_to_segment, group_config, SEGMENT_URL, SPOT_URL, MAX_SEGMENT_IDS, SPOT_PAGE_SIZE, \
+    SPOT_MAX_PAGES
+from api.circuit import CircuitBreaker, CircuitOpenError, is_upstream_failure
+from api.polling import AdaptivePollScheduler, FIXED_POLL_INTERVAL
+from api.async_parking import AsyncParkingFinder
+from api.batching import SpotBatchPlanner
+from api.fairness import FairScheduler, current_user, SYSTEM_USER
+from api.context import QueryContext, TokenCache, SegmentNameCache
+from api.jsonstream import ArrayItemDecoder
+from api.profiling import profiler
 
 # 設置日誌記錄，方便除錯
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +32,16 @@ SPOT_STATUS_MAP = {
     2: "空位",
 }
 
+# TDX 異常時，最後一次成功查詢結果可作為備援的最長秒數
+STALE_MAX_AGE = int(os.getenv("STALE_MAX_AGE", default=1800))
+
+# 保留 TDX 原始車格資料（逐筆記錄、放入 api_responses 回覆給用戶），僅供除錯；關閉時只保留各路段車格數
+TDX_KEEP_RAW_RESPONSES = os.getenv("TDX_KEEP_RAW_RESPONSES", default="false").lower() == "true"
+# 串流讀取動態車格回應時每次讀取的位元組數
+SPOT_STREAM_CHUNK = int(os.getenv("SPOT_STREAM_CHUNK", default=16384))
+# 動態車格查詢 $select 的欄位，解析時只保留這些欄位
+SPOT_FIELDS = ("ParkingSpotID", "ParkingSegmentID", "SpotStatus", "DataCollectTime")
+
 
 class Auth:
     def __init__(self, app_id, app_key):
@@ -44,37 +65,98 @@ class ParkingFinder:
             raise ValueError("TDX_APP_ID 和 TDX_APP_KEY 必須在環境變數中設定")
 
         self.auth = Auth(self.app_id, self.app_key)
-        self.access_token = None
-        self.token_expiry = 0
+        # 以下共用狀態皆為執行緒安全的結構；每次查詢的狀態放在 QueryContext
+        self.tokens = TokenCache()
         self.auth_url = "https://tdx.transportdata.tw/auth/realms/TDXConnect/protocol/openid-connect/token"
-        self.segment_name_cache = {}
+        self.segment_name_cache = SegmentNameCache()
         self.home_address = os.getenv("HOME_ADDRESS", "回家")
         self.home_city = self._map_city(self.home_address)[0]
-        self.api_call_count = 0
-        self.last_call_time = time.time()
         self.line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+        # 每個 TDX 端點各自的斷路器
+        self.breakers = {name: CircuitBreaker(name) for name in ("token", "segment", "segment_name", "spot")}
+        # 最後一次成功的查詢結果：(address, spot_number) -> (時間戳, 查詢結果)
+        self.last_good_results = {}
+        self._revalidating = set()
+        # 合併同時進行的動態車格查詢，同步與非同步查詢共用
+        self.spot_planner = SpotBatchPlanner()
+        # 所有 TDX 請求前的加權公平排程，並統計每位用戶的用量
+        self.fair_scheduler = FairScheduler()
+        # 非同步查詢介面，監控迴圈使用，共用上述 Token、快取與斷路器
+        self.async_finder = AsyncParkingFinder(self)
+        self._stale_lock = threading.Lock()
 
-    def _get_access_token(self):
-        current_time = time.time()
-        if self.access_token and current_time < self.token_expiry - 60:
-            return self.access_token
+    def _call_upstream(self, endpoint, method, url, consume=None, **kwargs):
+        """
+        經由斷路器呼叫 TDX，開路時立即拋出 CircuitOpenError，並依結果更新斷路器狀態。
+
+        指定 consume 時以串流方式請求，在持有排程名額與斷路器保護內呼叫 consume(response) 讀完內容並返回其結果；
+        讀取途中的逾時、連線中斷或內容不完整（ValueError）都計為上游失敗。
+        """
+        breaker = self.breakers[endpoint]
+        if not breaker.allow_request():
+            raise CircuitOpenError("TDX {} 端點暫時異常，{:.0f} 秒後重試".format(endpoint, breaker.retry_after()))
+        settled = False
+        try:
+            with self.fair_scheduler.slot():
+                try:
+                    response = requests.request(method, url, timeout=5, stream=consume is not None, **kwargs)
+                    if consume is not None and not response.ok:
+                        # 串流請求的錯誤回應先讀完，錯誤處理才能讀取內容，連線也能釋放
+                        response.content
+                    response.raise_for_status()
+                    result = response
+                    if consume is not None:
+                        with closing(response):
+                            result = consume(response)
+                except requests.exceptions.RequestException as e:
+                    if is_upstream_failure(e):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    settled = True
+                    raise
+                except ValueError:
+                    breaker.record_failure()
+                    settled = True
+                    raise
+            breaker.record_success()
+            settled = True
+        finally:
+            # 途中發生其他例外時釋放半開的探測名額，否則斷路器會一直拒絕呼叫
+            if not settled:
+                breaker.release_probe()
+        return result
 
-        if current_time - self.last_call_time < 60 and self.api_call_count >= 20:
-            logger.warning("接近 Access Token 每分鐘 20 次限制，等待 5 秒")
-            time.sleep(5)
+    def _get_access_token(self, query):
+        token = self.tokens.get()
+        if token:
+            return token
+        # 同時到期的多個執行緒只取一次 Token
+        with self.tokens.refresh_lock:
+            token = self.tokens.get()
+            if token:
+                return token
+            return self._fetch_access_token(query)
+
+    def _fetch_access_token(self, query):
+        wait = self.tokens.record_request()
+        if wait > 0:
+            logger.warning("接近 Access Token 每分鐘 20 次限制，等待 {:.0f} 秒".format(wait))
+            time.sleep(wait)
 
         try:
             logger.info("開始取得 Access Token")
             start_time = time.time()
-            auth_response = requests.post(self.auth_url, data=self.auth.get_auth_header(), timeout=5)
-            auth_response.raise_for_status()
+            auth_response = self._call_upstream("token", "POST", self.auth_url, data=self.auth.get_auth_header())
             auth_json = auth_response.json()
-            self.access_token = auth_json.get('access_token')
-            self.token_expiry = current_time + auth_json.get('expires_in', 86400) - 60
-            self.api_call_count += 1
-            self.last_call_time = current_time
+            token = auth_json.get('access_token')
+            self.tokens.store(token, auth_json.get('expires_in', 86400), start_time)
+            query.count_call()
             logger.info("取得 Access Token 成功，耗時 {} 秒".format(time.time() - start_time))
-            return self.access_token
+            return token
+        except CircuitOpenError as e:
+            logger.error("取得 Access Token 失敗: {}".format(str(e)))
+            raise Exception("取得 Access Token 失敗：TDX 服務暫時異常，請稍後再試")
         except requests.exceptions.Timeout:
             logger.error("取得 Access Token 失敗: 請求超時 (504 Gateway Timeout)")
             raise Exception("取得 Access Token 失敗：請求超時，請稍後再試")
@@ -88,9 +170,9 @@ class ParkingFinder:
             logger.error("取得 Access Token 失敗: {}".format(str(e)))
             raise
 
-    def _get_data_header(self):
+    def _get_data_header(self, query):
         return {
-            'authorization': 'Bearer {}'.format(self._get_access_token()),
+            'authorization': 'Bearer {}'.format(self._get_access_token(query)),
             'Accept-Encoding': 'gzip'
         }
 
@@ -128,23 +210,22 @@ class ParkingFinder:
                 return city_code, remaining_address
         return "Taipei", address
 
-    def _get_parking_segments(self, city, address):
-        url = "https://tdx.transportdata.tw/api/basic/v1/Parking/OnStreet/ParkingSegment/City/{}".format(city)
+    def _get_parking_segments(self, city, address, query):
+        url = SEGMENT_URL.format(city)
         params = {"$format": "JSON", "$top": 100, "$select": "ParkingSegmentID,ParkingSegmentName"}
         params["$filter"] = "contains(ParkingSegmentName/Zh_tw,'{}')".format(address)
         try:
             logger.info("開始路段查詢，地址: {}".format(address))
             start_time = time.time()
-            response = requests.get(url, headers=self._get_data_header(), params=params, timeout=5)
-            response.raise_for_status()
+            response = self._call_upstream("segment", "GET", url, headers=self._get_data_header(query), params=params)
             data = response.json()
-            self.api_call_count += 1
+            query.count_call()
             logger.info("路段查詢成功，耗時 {} 秒".format(time.time() - start_time))
             if data.get("ParkingSegments"):
                 for segment in data.get("ParkingSegments", []):
                     seg_id = segment.get("ParkingSegmentID")
                     seg_name = segment.get("ParkingSegmentName", {}).get("Zh_tw", "未知路段")
-                    self.segment_name_cache[seg_id] = seg_name
+                    self.segment_name_cache.set(seg_id, seg_name)
                 return data
             return {"error": "路段查詢錯誤：無匹配路段", "api_response": data}
         except requests.exceptions.Timeout:
@@ -168,174 +249,298 @@ class ParkingFinder:
             logger.error("路段查詢錯誤 (地址: {}): {}".format(address, str(e)))
             return {"error": "路段查詢錯誤：查詢失敗，請檢查網路或稍後再試", "api_response": {"error": str(e)}}
 
-    def _get_segment_names(self, city, segment_ids):
+    def _get_segment_names(self, city, segment_ids, query):
         if not segment_ids:
             return {}
         result = {}
-        uncached_ids = [seg_id for seg_id in segment_ids if seg_id not in self.segment_name_cache]
+        cached_names, uncached_ids = self.segment_name_cache.lookup(segment_ids)
         if not uncached_ids:
-            return {seg_id: self.segment_name_cache[seg_id] for seg_id in segment_ids}
+            return cached_names
 
         # 分批處理，最多 20 個路段 ID
-        MAX_SEGMENT_IDS = 20
         for i in range(0, len(uncached_ids), MAX_SEGMENT_IDS):
             batch_ids = uncached_ids[i:i + MAX_SEGMENT_IDS]
-            url = "https://tdx.transportdata.tw/api/basic/v1/Parking/OnStreet/ParkingSegment/City/{}".format(city)
-            params = {
-                "$format": "JSON",
-                "$top": 100,
-                "$select": "ParkingSegmentID,ParkingSegmentName",
-                "$filter": "ParkingSegmentID in ({})".format(','.join(["'{}'".format(id) for id in batch_ids]))
-            }
+            url = SEGMENT_URL.format(city)
+            params = self._segment_name_params(batch_ids)
             try:
                 logger.info("開始路段名稱查詢，路段 ID: {}".format(batch_ids))
                 start_time = time.time()
-                response = requests.get(url, headers=self._get_data_header(), params=params, timeout=5)
-                response.raise_for_status()
+                response = self._call_upstream("segment_name", "GET", url, headers=self._get_data_header(query),
+                                               params=params)
                 data = response.json()
-                self.api_call_count += 1
+                query.count_call()
                 logger.info("路段名稱查詢成功，耗時 {} 秒".format(time.time() - start_time))
-                for segment in data.get("ParkingSegments", []):
-                    seg_id = segment.get("ParkingSegmentID")
-                    seg_name = segment.get("ParkingSegmentName", {}).get("Zh_tw", "未知路段")
-                    self.segment_name_cache[seg_id] = seg_name
-                    result[seg_id] = seg_name
-                for seg_id in batch_ids:
-                    if seg_id not in result:
-                        result[seg_id] = {"error": "路段名稱查詢錯誤：未知路段", "api_response": data}
+                result.update(self._parse_segment_names(data, batch_ids))
             except requests.exceptions.Timeout:
                 logger.error("路段名稱查詢錯誤: 請求超時 (504 Gateway Timeout)")
                 for seg_id in batch_ids:
                     result[seg_id] = {"error": "路段名稱查詢錯誤：請求超時", "api_response": {}}
             except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429:
-                    logger.error("路段名稱查詢錯誤: API 速率限制 (429 Too Many Requests)")
-                    for seg_id in batch_ids:
-                        result[seg_id] = {"error": "路段名稱查詢錯誤：API 速率限制", "api_response": {}}
-                elif e.response.status_code == 500:
-                    logger.error("路段名稱查詢錯誤: 伺服器錯誤 (500 Internal Server Error)")
-                    try:
-                        for seg_id in batch_ids:
-                            result[seg_id] = {"error": "路段名稱查詢錯誤：伺服器錯誤", "api_response": e.response.json()}
-                    except ValueError:
-                        for seg_id in batch_ids:
-                            result[seg_id] = {"error": "路段名稱查詢錯誤：伺服器錯誤",
-                                              "api_response": {"error": e.response.text}}
-                else:
-                    logger.error("路段名稱查詢錯誤: {}".format(str(e)))
-                    try:
-                        for seg_id in batch_ids:
-                            result[seg_id] = {"error": "路段名稱查詢錯誤：查詢失敗", "api_response": e.response.json()}
-                    except ValueError:
-                        for seg_id in batch_ids:
-                            result[seg_id] = {"error": "路段名稱查詢錯誤：查詢失敗",
-                                              "api_response": {"error": e.response.text}}
+                logger.error("路段名稱查詢錯誤: {}".format(str(e)))
+                result.update(self._segment_name_http_error(e.response, batch_ids))
             except requests.exceptions.RequestException as e:
                 logger.error("路段名稱查詢錯誤: {}".format(str(e)))
                 for seg_id in batch_ids:
                     result[seg_id] = {"error": "路段名稱查詢錯誤：查詢失敗", "api_response": {"error": str(e)}}
 
         for seg_id in segment_ids:
-            if seg_id not in result and seg_id in self.segment_name_cache:
-                result[seg_id] = self.segment_name_cache[seg_id]
+            if seg_id not in result and seg_id in cached_names:
+                result[seg_id] = cached_names[seg_id]
         return result
 
-    def _get_parking_spots(self, city, segment_ids, spot_number=None):
+    def _segment_name_params(self, batch_ids):
+        return {
+            "$format": "JSON",
+            "$top": 100,
+            "$select": "ParkingSegmentID,ParkingSegmentName",
+            "$filter": "ParkingSegmentID in ({})".format(','.join(["'{}'".format(id) for id in batch_ids]))
+        }
+
+    def _parse_segment_names(self, data, batch_ids):
+        result = {}
+        for segment in data.get("ParkingSegments", []):
+            seg_id = segment.get("ParkingSegmentID")
+            seg_name = segment.get("ParkingSegmentName", {}).get("Zh_tw", "未知路段")
+            self.segment_name_cache.set(seg_id, seg_name)
+            result[seg_id] = seg_name
+        for seg_id in batch_ids:
+            if seg_id not in result:
+                result[seg_id] = {"error": "路段名稱查詢錯誤：未知路段", "api_response": data}
+        return result
+
+    def _segment_name_http_error(self, response, batch_ids):
+        """依 HTTP 狀態碼產生路段名稱查詢的錯誤結果（requests 與 httpx 的 response 皆適用）。"""
+        if response.status_code == 429:
+            logger.error("路段名稱查詢錯誤: API 速率限制 (429 Too Many Requests)")
+            return {seg_id: {"error": "路段名稱查詢錯誤：API 速率限制", "api_response": {}} for seg_id in batch_ids}
+        if response.status_code == 500:
+            logger.error("路段名稱查詢錯誤: 伺服器錯誤 (500 Internal Server Error)")
+            error = "路段名稱查詢錯誤：伺服器錯誤"
+        else:
+            error = "路段名稱查詢錯誤：查詢失敗"
+        try:
+            api_response = response.json()
+        except ValueError:
+            api_response = {"error": response.text}
+        return {seg_id: {"error": error, "api_response": api_response} for seg_id in batch_ids}
+
+    def _get_spot_batch(self, city, batch_ids, spot_number, query, headers=None):
+        """
+        查詢一批動態車格，成功返回 TDX 回應資料（"calls" 為分頁查詢的次數），失敗返回錯誤結果（含 "error"）。
+        回應筆數達到 $top 時以 $skip 繼續查詢下一頁，車格不會因為合併批次過大而被截斷。
+        """
+        url = SPOT_URL.format(city)
+        try:
+            start_time = time.time()
+            headers = headers or self._get_data_header(query)
+            spots = []
+            seen = set()
+            for page in range(SPOT_MAX_PAGES):
+                params = self._spot_params(batch_ids, spot_number, skip=page * SPOT_PAGE_SIZE)
+                logger.info("開始動態車格查詢，路段 ID: {}，過濾條件: {}，第 {} 頁".format(
+                    batch_ids, params["$filter"], page + 1))
+                page_spots = self._call_upstream("spot", "GET", url, consume=self._read_spots, headers=headers,
+                                                 params=params)
+                query.count_call()
+                spots.extend(self._new_spots(page_spots, seen))
+                if len(page_spots) < SPOT_PAGE_SIZE:
+                    logger.info("動態車格查詢成功，耗時 {} 秒".format(time.time() - start_time))
+                    return {"CurbSpotParkingAvailabilities": spots, "calls": page + 1}
+            return self._spot_overflow_error(batch_ids)
+        except requests.exceptions.Timeout:
+            logger.error("動態車格查詢錯誤: 請求超時 (504 Gateway Timeout)")
+            return {"error": "動態車格查詢錯誤：請求超時，請稍後再試", "api_response": {},
+                    "api_responses": {seg_id: {"error": "請求超時"} for seg_id in batch_ids}}
+        except requests.exceptions.HTTPError as e:
+            return self._spot_http_error(e.response, batch_ids)
+        except requests.exceptions.RequestException as e:
+            logger.error("動態車格查詢錯誤: {}".format(str(e)))
+            return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試", "api_response": {"error": str(e)},
+                    "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
+        except ValueError as e:
+            return self._spot_format_error(e, batch_ids)
+
+    @staticmethod
+    def _new_spots(page_spots, seen):
+        """分頁間資料變動可能讓同一車格出現在兩頁，只保留尚未出現過的 ParkingSpotID。"""
+        spots = []
+        for spot in page_spots:
+            spot_id = spot.get("ParkingSpotID")
+            if spot_id is not None:
+                if spot_id in seen:
+                    continue
+                seen.add(spot_id)
+            spots.append(spot)
+        return spots
+
+    @staticmethod
+    def _spot_overflow_error(batch_ids):
+        logger.error("動態車格查詢錯誤: 超過 {} 頁仍未取得全部車格".format(SPOT_MAX_PAGES))
+        return {"error": "動態車格查詢錯誤：車格數超過查詢上限，請稍後再試",
+                "api_response": {"error": "超過 {} 頁".format(SPOT_MAX_PAGES)},
+                "api_responses": {seg_id: {"error": "車格數超過查詢上限"} for seg_id in batch_ids}}
+
+    def _get_shared_spot_batch(self, city, batch_ids, user_ids, headers):
+        """送出合併後的動態車格批次；依參與用戶的虛擬時間排程，呼叫數由各參與的查詢依用到的批次數自行計入。"""
+        with self.fair_scheduler.for_users(user_ids):
+            return self._get_spot_batch(city, batch_ids, None, QueryContext(user_id=SYSTEM_USER), headers)
+
+    def _charge_shared_calls(self, query, calls):
+        """合併批次中此查詢用到的批次數計入查詢與目前用戶。"""
+        query.count_call(calls)
+        self.fair_scheduler.charge(calls)
+
+    def _read_spots(self, response):
+        """邊下載邊解析動態車格回應，返回精簡後的車格列表。"""
+        decoder = ArrayItemDecoder("CurbSpotParkingAvailabilities")
+        spots = []
+        for chunk in response.iter_content(chunk_size=SPOT_STREAM_CHUNK):
+            spots.extend(self._compact_spot(item) for item in decoder.feed(chunk))
+        spots.extend(self._compact_spot(item) for item in decoder.close())
+        return spots
+
+    @staticmethod
+    def _compact_spot(item):
+        """只保留 SPOT_FIELDS 的精簡車格紀錄（缺少的欄位不補，交給 _collect_spot_batch 檢查）。"""
+        if not isinstance(item, dict):
+            return {}
+        return {field: item[field] for field in SPOT_FIELDS if field in item}
+
+    @staticmethod
+    def _spot_format_error(error, batch_ids):
+        logger.error("動態車格查詢錯誤: 回應格式錯誤，{}".format(str(error)))
+        return {"error": "動態車格查詢錯誤：API 回應格式錯誤，請稍後再試", "api_response": {"error": str(error)},
+                "api_responses": {seg_id: {"error": "回應格式錯誤"} for seg_id in batch_ids}}
+
+    @staticmethod
+    def _empty_spot_responses(segment_ids):
+        """各路段 api_responses 的初始值：保留原始資料時為車格列表，否則只記車格數。"""
+        if TDX_KEEP_RAW_RESPONSES:
+            return {seg_id: {"CurbSpotParkingAvailabilities": []} for seg_id in segment_ids}
+        return {seg_id: {"spot_count": 0} for seg_id in segment_ids}
+
+    def _get_parking_spots(self, city, segment_ids, spot_number, query):
         if not segment_ids:
             return {"error": "動態車格查詢錯誤：無有效的路段 ID", "api_response": {}}
 
-        # 分批處理，最多 20 個路段 ID
-        MAX_SEGMENT_IDS = 20
+        if spot_number:
+            # 指定車格號的過濾條件無法與其他查詢共用，分批處理，最多 20 個路段 ID
+            batches = [segment_ids[i:i + MAX_SEGMENT_IDS] for i in range(0, len(segment_ids), MAX_SEGMENT_IDS)]
+            batch_results = (self._get_spot_batch(city, batch_ids, spot_number, query) for batch_ids in batches)
+        else:
+            # 與同時進行的其他查詢、監控合併成共用的 20 ID 批次；Token 由此查詢取得並計入
+            headers = self._get_data_header(query)
+            data, calls = self.spot_planner.fetch(
+                city, segment_ids, lambda batch_ids, user_ids: self._get_shared_spot_batch(city, batch_ids, user_ids, headers))
+            self._charge_shared_calls(query, calls)
+            batches = [segment_ids]
+            batch_results = [data]
+
         all_spots = []
-        api_responses = {seg_id: {"CurbSpotParkingAvailabilities": []} for seg_id in segment_ids}
-        for i in range(0, len(segment_ids), MAX_SEGMENT_IDS):
-            batch_ids = segment_ids[i:i + MAX_SEGMENT_IDS]
-            url = "https://tdx.transportdata.tw/api/basic/v1/Parking/OnStreet/ParkingSpotAvailability/City/{}".format(
-                city)
-            filter_conditions = ["ParkingSegmentID in ({})".format(','.join(["'{}'".format(id) for id in batch_ids])),
-                                 "SpotStatus ne 1"]
-            if spot_number:
-                filter_conditions.append("contains(ParkingSpotID,'{}')".format(spot_number))
-            params = {
-                "$format": "JSON",
-                "$top": 1000,  # 增加以確保覆蓋更多車格
-                "$select": "ParkingSpotID,ParkingSegmentID,SpotStatus,DataCollectTime",
-                "$filter": " and ".join(filter_conditions)
-            }
-            try:
-                logger.info("開始動態車格查詢，路段 ID: {}，過濾條件: {}".format(batch_ids, params["$filter"]))
-                start_time = time.time()
-                response = requests.get(url, headers=self._get_data_header(), params=params, timeout=5)
-                response.raise_for_status()
-                data = response.json()
-                self.api_call_count += 1
+        collect_times = {}
+        api_responses = self._empty_spot_responses(segment_ids)
+        for batch_ids, data in zip(batches, batch_results):
+            if "error" in data:
+                return data
+            error = self._collect_spot_batch(data, batch_ids, api_responses, all_spots, collect_times)
+            if error:
+                return error
+        return {"CurbSpotParkingAvailabilities": all_spots, "api_response": {"batched": True},
+                "api_responses": api_responses, "collect_times": collect_times}
+
+    def _spot_params(self, batch_ids, spot_number=None, skip=0):
+        filter_conditions = ["ParkingSegmentID in ({})".format(','.join(["'{}'".format(id) for id in batch_ids])),
+                             "SpotStatus ne 1"]
+        if spot_number:
+            filter_conditions.append("contains(ParkingSpotID,'{}')".format(spot_number))
+        params = {
+            "$format": "JSON",
+            "$top": SPOT_PAGE_SIZE,
+            "$select": "ParkingSpotID,ParkingSegmentID,SpotStatus,DataCollectTime",
+            "$filter": " and ".join(filter_conditions),
+            # 固定排序，分頁才不會重複或遺漏
+            "$orderby": "ParkingSpotID"
+        }
+        if skip:
+            params["$skip"] = skip
+        return params
+
+    def _collect_spot_batch(self, data, batch_ids, api_responses, all_spots, collect_times):
+        """
+        將一批動態車格併入累計結果，每筆車格只走訪一次；
+        有車格缺少必要欄位時返回錯誤結果，否則返回 None。
+        """
+        spots = data.get("CurbSpotParkingAvailabilities", [])
+        spot_info = [] if TDX_KEEP_RAW_RESPONSES else None
+        invalid_spots = []
+        for spot in spots:
+            seg_id = spot.get("ParkingSegmentID")
+            collect_time = spot.get("DataCollectTime")
+            if "ParkingSpotID" not in spot or seg_id is None or collect_time is None:
+                invalid_spots.append(spot)
+            if seg_id in api_responses:
+                if TDX_KEEP_RAW_RESPONSES:
+                    api_responses[seg_id]["CurbSpotParkingAvailabilities"].append(spot)
+                else:
+                    api_responses[seg_id]["spot_count"] += 1
+            all_spots.append(spot)
+            if seg_id and collect_time and collect_time > collect_times.get(seg_id, ""):
+                collect_times[seg_id] = collect_time
+            if spot_info is not None:
                 # 記錄返回的車格 ID、路段 ID、解析車格號和 SpotStatus
-                spot_info = [
-                    {
-                        "ParkingSpotID": spot.get("ParkingSpotID", "未知"),
-                        "ParkingSegmentID": spot.get("ParkingSegmentID", "未知"),
-                        "SpotNumber": spot.get("ParkingSpotID", "未知")[len(spot.get("ParkingSegmentID", "")):].lstrip(
-                            "0") if spot.get("ParkingSpotID", "").startswith(
-                            spot.get("ParkingSegmentID", "")) else spot.get("ParkingSpotID", "未知"),
-                        "SpotStatus": SPOT_STATUS_MAP.get(spot.get("SpotStatus"),
-                                                          "未知（狀態碼 {}）".format(spot.get("SpotStatus")))
-                    }
-                    for spot in data.get("CurbSpotParkingAvailabilities", [])
-                ]
-                logger.info("動態車格查詢返回車格: {}".format(json.dumps(spot_info, ensure_ascii=False)))
-                for spot in data.get("CurbSpotParkingAvailabilities", []):
-                    seg_id = spot.get("ParkingSegmentID")
-                    if seg_id in api_responses:
-                        api_responses[seg_id]["CurbSpotParkingAvailabilities"].append(spot)
-                    all_spots.append(spot)
-                if not data.get("CurbSpotParkingAvailabilities"):
-                    logger.info("路段 {} 無符合過濾條件的車格資料".format(batch_ids))
-                    continue
-                if not all(
-                        "ParkingSpotID" in spot and "ParkingSegmentID" in spot and "DataCollectTime" in spot for spot in
-                        data["CurbSpotParkingAvailabilities"]):
-                    return {"error": "動態車格查詢錯誤：API 回應資料不完整，缺少必要欄位", "api_response": data,
-                            "api_responses": api_responses}
-                logger.info("動態車格查詢成功，耗時 {} 秒".format(time.time() - start_time))
-            except requests.exceptions.Timeout:
-                logger.error("動態車格查詢錯誤: 請求超時 (504 Gateway Timeout)")
-                return {"error": "動態車格查詢錯誤：請求超時，請稍後再試", "api_response": {},
-                        "api_responses": {seg_id: {"error": "請求超時"} for seg_id in batch_ids}}
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429:
-                    logger.error("動態車格查詢錯誤: API 速率限制 (429 Too Many Requests)")
-                    return {"error": "動態車格查詢錯誤：API 速率限制，請稍後再試", "api_response": {},
-                            "api_responses": {seg_id: {"error": "API 速率限制"} for seg_id in batch_ids}}
-                elif e.response.status_code == 500:
-                    logger.error("動態車格查詢錯誤: 伺服器錯誤 (500 Internal Server Error)")
-                    return {"error": "動態車格查詢錯誤：伺服器錯誤，請稍後再試",
-                            "api_response": e.response.json() if e.response.text else {},
-                            "api_responses": {seg_id: {"error": "伺服器錯誤"} for seg_id in batch_ids}}
-                elif e.response.status_code == 401:
-                    logger.error("動態車格查詢錯誤: 未授權 (401 Unauthorized)")
-                    return {"error": "動態車格查詢錯誤：API 認證失敗，請檢查 TDX 金鑰", "api_response": {},
-                            "api_responses": {seg_id: {"error": "API 認證失敗"} for seg_id in batch_ids}}
-                logger.error("動態車格查詢錯誤: {}".format(str(e)))
-                try:
-                    return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試",
-                            "api_response": e.response.json(),
-                            "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
-                except ValueError:
-                    return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試",
-                            "api_response": {"error": e.response.text},
-                            "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
-            except requests.exceptions.RequestException as e:
-                logger.error("動態車格查詢錯誤: {}".format(str(e)))
-                return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試", "api_response": {"error": str(e)},
-                        "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
+                spot_id = spot.get("ParkingSpotID", "未知")
+                spot_info.append({
+                    "ParkingSpotID": spot_id,
+                    "ParkingSegmentID": seg_id or "未知",
+                    "SpotNumber": spot_id[len(seg_id or ""):].lstrip("0") if spot_id.startswith(seg_id or "") else spot_id,
+                    "SpotStatus": SPOT_STATUS_MAP.get(spot.get("SpotStatus"),
+                                                      "未知（狀態碼 {}）".format(spot.get("SpotStatus")))
+                })
+        if spot_info is not None:
+            logger.info("動態車格查詢返回車格: {}".format(json.dumps(spot_info, ensure_ascii=False)))
+        else:
+            logger.info("動態車格查詢返回 {} 個車格".format(len(spots)))
+        if not spots:
+            logger.info("路段 {} 無符合過濾條件的車格資料".format(batch_ids))
+            return None
+        if invalid_spots:
+            return {"error": "動態車格查詢錯誤：API 回應資料不完整，缺少必要欄位",
+                    "api_response": data if TDX_KEEP_RAW_RESPONSES else {"invalid_spots": invalid_spots[:10]},
+                    "api_responses": api_responses}
+        return None
 
-        return {"CurbSpotParkingAvailabilities": all_spots, "api_response": {"batched": True},
-                "api_responses": api_responses}
+    def _spot_http_error(self, response, batch_ids):
+        """依 HTTP 狀態碼產生動態車格查詢的錯誤結果（requests 與 httpx 的 response 皆適用）。"""
+        if response.status_code == 429:
+            logger.error("動態車格查詢錯誤: API 速率限制 (429 Too Many Requests)")
+            return {"error": "動態車格查詢錯誤：API 速率限制，請稍後再試", "api_response": {},
+                    "api_responses": {seg_id: {"error": "API 速率限制"} for seg_id in batch_ids}}
+        elif response.status_code == 500:
+            logger.error("動態車格查詢錯誤: 伺服器錯誤 (500 Internal Server Error)")
+            return {"error": "動態車格查詢錯誤：伺服器錯誤，請稍後再試",
+                    "api_response": response.json() if response.text else {},
+                    "api_responses": {seg_id: {"error": "伺服器錯誤"} for seg_id in batch_ids}}
+        elif response.status_code == 401:
+            logger.error("動態車格查詢錯誤: 未授權 (401 Unauthorized)")
+            return {"error": "動態車格查詢錯誤：API 認證失敗，請檢查 TDX 金鑰", "api_response": {},
+                    "api_responses": {seg_id: {"error": "API 認證失敗"} for seg_id in batch_ids}}
+        logger.error("動態車格查詢錯誤: HTTP {}".format(response.status_code))
+        try:
+            return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試",
+                    "api_response": response.json(),
+                    "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
+        except ValueError:
+            return {"error": "動態車格查詢錯誤：查詢失敗，請檢查網路或稍後再試",
+                    "api_response": {"error": response.text},
+                    "api_responses": {seg_id: {"error": "查詢失敗"} for seg_id in batch_ids}}
 
     def find_grouped_parking_spots(self, address, spot_number=None):
         """
         查詢指定地址的停車位狀態，並返回分組後的結果和空車格 ID 集合。
 
+        TDX 異常（斷路器開路、逾時或 5xx）時，改以最後一次成功的查詢結果回應並標示資料時間，
+        同時在背景重新查詢，成功後斷路器即恢復正常。
+
         Args:
             address (str): 查詢地址（例如 "青年公園" 或 "回家"）
             spot_number (str, optional): 特定車格號（例如 "112"）
@@ -343,82 +548,266 @@ class ParkingFinder:
         Returns:
             tuple: (response_text, error_msgs, api_responses, available_spot_ids)
         """
-        # 重置 API 呼叫計數
-        self.api_call_count = 0
-        error_msgs = []
-        api_responses = []
-        response_text = ""
-        available_spot_ids = set()
+        return self.as_tuple(self.find_grouped_parking_data(address, spot_number))
 
-        if not isinstance(address, str):
-            logger.error("地址輸入無效: 必須是字串，收到 {}".format(type(address)))
-            error_msgs.append("地址輸入無效，請提供有效的地址字串（例如：停車 青年公園）")
-            response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-            return response_text, error_msgs, api_responses, available_spot_ids
+    def find_grouped_parking_data(self, address, spot_number=None, max_age=0):
+        """
+        與 find_grouped_parking_spots 相同的查詢，返回包含結構化分組資料的 dict。
 
-        # 若地址為「回家」，使用環境變數 HOME_ADDRESS
-        if address.lower() == "回家":
-            address = self.home_address
-            logger.info("使用 HOME_ADDRESS: {}".format(address))
+        Args:
+            address (str): 查詢地址（例如 "青年公園" 或 "回家"）
+            spot_number (str, optional): 特定車格號（例如 "112"）
+            max_age (int): 最後成功結果在此秒數內時直接使用，不呼叫 API（預設 0，一律重新查詢）
 
-        city, remaining_address = self._map_city(address)
-        if not remaining_address:
-            error_msgs.append("地址輸入無效，請提供具體的路段或集合名稱（例如：青年公園）")
-            response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-            return response_text, error_msgs, api_responses, available_spot_ids
+        Returns:
+            dict: response_text、error_msgs、api_responses、available_spot_ids，以及
+                segments（依空車位數排序的路段/分組/車格）、collect_times（各路段最新 DataCollectTime）、
+                ok（是否取得車格資料）與 stale_age（使用快取時的資料秒數，否則為 None）
+        """
+        key = (address, spot_number)
+        if max_age > 0:
+            with self._stale_lock:
+                entry = self.last_good_results.get(key)
+            if entry is not None and time.time() - entry[0] <= max_age:
+                return entry[1]
+        # 用戶超過 TDX 配額時改回應快取，無快取則照常查詢（由公平排程排在其他用戶之後）
+        over_quota = self._serve_over_quota(key)
+        if over_quota is not None:
+            return over_quota
+        # 此查詢用到的端點斷路器未恢復時直接回應快取，不等待上游逾時
+        if not self._upstream_healthy(address):
+            stale = self._serve_stale(key)
+            if stale is not None:
+                return stale
 
-        segment_ids = []
-        segment_groups = {}
+        failures_before = self._upstream_failure_count(address)
+        try:
+            result = self._query_grouped_parking_spots(address, spot_number)
+        except Exception:
+            stale = self._serve_stale(key)
+            if stale is not None:
+                return stale
+            raise
+        return self._settle_result(key, result, failures_before)
+
+    @staticmethod
+    def as_tuple(result):
+        return result["response_text"], result["error_msgs"], result["api_responses"], result["available_spot_ids"]
+
+    def _settle_result(self, key, result, failures_before):
+        """成功的結果記為最後成功結果；因上游異常失敗時改回應快取（若有）。"""
+        upstream_failed = self._upstream_failure_count(key[0]) > failures_before or not self._upstream_healthy(key[0])
+        if result["ok"]:
+            with self._stale_lock:
+                self.last_good_results[key] = (time.time(), result)
+        elif upstream_failed:
+            stale = self._serve_stale(key)
+            if stale is not None:
+                return stale
+        return result
+
+    def _query_breakers(self, address=None):
+        """查詢 address 會用到的端點斷路器：固定地址只需 Token 與動態車格，其他地址四個端點都會用到。"""
+        if address is not None and self.is_alias(address):
+            return [self.breakers["token"], self.breakers["spot"]]
+        return list(self.breakers.values())
+
+    def _upstream_healthy(self, address=None):
+        """查詢 address 用到的端點是否都可呼叫（open 超過 reset_timeout 者可探測，也視為可呼叫）。"""
+        return all(breaker.is_available() for breaker in self._query_breakers(address))
+
+    def _upstream_failure_count(self, address=None):
+        return sum(breaker.total_failures for breaker in self._query_breakers(address))
+
+    def _serve_stale(self, key):
+        """返回標示資料時間的最後成功結果，並觸發背景重新查詢；無可用快取時返回 None。"""
+        with self._stale_lock:
+            entry = self.last_good_results.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        age = int(time.time() - stored_at)
+        if age > STALE_MAX_AGE:
+            return None
+        self._revalidate_in_background(*key)
+        logger.warning("TDX 服務異常，使用{}前的快取結果，地址: {}".format(self._age_text(age), key[0]))
+        return self._annotated_copy(result, age, "TDX 服務暫時異常")
+
+    def _serve_over_quota(self, key):
+        """目前用戶超過 TDX 配額時返回標示資料時間的最後成功結果；未超過或無可用快取時返回 None。"""
+        if not self.fair_scheduler.over_quota():
+            return None
+        with self._stale_lock:
+            entry = self.last_good_results.get(key)
+        user_id = current_user.get()
+        if entry is None or time.time() - entry[0] > STALE_MAX_AGE:
+            logger.warning("用戶 {} 超過 TDX 配額且無快取，排隊查詢，地址: {}".format(user_id, key[0]))
+            return None
+        age = int(time.time() - entry[0])
+        self.fair_scheduler.record_degraded()
+        logger.warning("用戶 {} 超過 TDX 配額，使用{}前的快取結果，地址: {}".format(user_id, self._age_text(age), key[0]))
+        return self._annotated_copy(entry[1], age, "查詢次數已達上限，{:.0f} 秒後恢復".format(
+            self.fair_scheduler.retry_after()))
+
+    @staticmethod
+    def _age_text(age):
+        return "{}秒".format(age) if age < 60 else "{}分鐘".format(age // 60)
+
+    def _annotated_copy(self, result, age, reason):
+        """複製快取結果，在回應開頭標示原因與資料時間；此次回應未呼叫 API，呼叫次數改為 0。"""
+        stale = dict(result)
+        response_text = re.sub(r"此次查詢共呼叫 \d+ 次 API", "此次查詢共呼叫 0 次 API", result["response_text"])
+        stale["response_text"] = "（{}，以下為{}前的資料）\n{}".format(reason, self._age_text(age), response_text)
+        stale["error_msgs"] = list(result["error_msgs"])
+        stale["api_responses"] = []
+        stale["available_spot_ids"] = set(result["available_spot_ids"])
+        stale["stale_age"] = age
+        return stale
+
+    def _revalidate_in_background(self, address, spot_number):
+        key = (address, spot_number)
+        with self._stale_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+        threading.Thread(target=self._revalidate, args=key, daemon=True).start()
+
+    def _revalidate(self, address, spot_number):
+        key = (address, spot_number)
+        try:
+            # 等到此查詢用到的斷路器允許探測再重新查詢，查詢本身即為探測，成功即關閉斷路器並更新快取
+            wait = max(breaker.retry_after() for breaker in self._query_breakers(address))
+            if wait:
+                time.sleep(wait)
+            result = self._query_grouped_parking_spots(address, spot_number)
+            if result["ok"]:
+                with self._stale_lock:
+                    self.last_good_results[key] = (time.time(), result)
+                logger.info("背景重新查詢成功，地址: {}".format(address))
+            else:
+                logger.warning("背景重新查詢失敗，地址: {}，錯誤: {}".format(address, result["error_msgs"]))
+        except Exception as e:
+            logger.warning("背景重新查詢失敗，地址: {}，錯誤: {}".format(address, str(e)))
+        finally:
+            with self._stale_lock:
+                self._revalidating.discard(key)
+
+    def _query_grouped_parking_spots(self, address, spot_number=None):
+        # 每次查詢各自的上下文與計數，並行查詢不互相覆蓋
+        query = QueryContext(address, spot_number, current_user.get())
+        error_msgs = []
+        api_responses = []
+
+        city, remaining_address, address_error = self._normalize_address(address)
+        if address_error:
+            error_msgs.append(address_error)
+            return self._error_result(error_msgs, api_responses, query.api_calls)
 
         if remaining_address in address_to_segment:
-            logger.info("地址 {} 在 address_to_segment 中，提取路段 ID".format(remaining_address))
-            for item in address_to_segment[remaining_address]:
-                if ":" in item["id"]:
-                    seg_id, group_name = item["id"].split(":")
-                    segment_ids.append(seg_id)
-                    segment_groups[seg_id] = segment_groups.get(seg_id, []) + [group_name]
-                else:
-                    segment_ids.append(item["id"])
-                    segment_groups[item["id"]] = [g["name"] for g in group_config.get(item["id"], [])]
-            # 優先使用 address_to_segment 的名稱
-            segment_names = {}
-            for item in address_to_segment[remaining_address]:
-                seg_id = item["id"].split(":")[0] if ":" in item["id"] else item["id"]
-                segment_names[seg_id] = item["name"]
-            logger.info("提取的路段 ID: {}，路段名稱: {}，分組: {}".format(segment_ids, segment_names, segment_groups))
+            segment_ids, segment_groups, segment_names = self._resolve_alias_segments(remaining_address)
         else:
-            segment_data = self._get_parking_segments(city, remaining_address)
+            segment_groups = {}
+            segment_data = self._get_parking_segments(city, remaining_address, query)
             if isinstance(segment_data, dict) and "error" in segment_data:
                 error_msgs.append("找不到 {} 的路段資料：{}。\n請嘗試以下地址：{}".format(
                     remaining_address, segment_data["error"], ", ".join(address_to_segment.keys())))
                 api_responses.append(segment_data["api_response"])
-                response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-                return response_text, error_msgs, api_responses, available_spot_ids
+                return self._error_result(error_msgs, api_responses, query.api_calls)
             if not isinstance(segment_data, dict) or "ParkingSegments" not in segment_data:
                 error_msgs.append("找不到 {} 的路段資料，請嘗試以下地址：{}。".format(
                     remaining_address, ", ".join(address_to_segment.keys())))
                 api_responses.append(segment_data)
-                response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-                return response_text, error_msgs, api_responses, available_spot_ids
+                return self._error_result(error_msgs, api_responses, query.api_calls)
             segment_ids = [s["ParkingSegmentID"] for s in segment_data["ParkingSegments"] if "ParkingSegmentID" in s]
             for seg_id in segment_ids:
                 segment_groups[seg_id] = [g["name"] for g in group_config.get(seg_id, [])]
-            segment_names = self._get_segment_names(city, segment_ids)
+            segment_names = self._get_segment_names(city, segment_ids, query)
             for seg_id, name_info in segment_names.items():
                 if isinstance(name_info, dict) and "error" in name_info:
                     error_msgs.append("無法查詢路段 {} 的名稱：{}。".format(seg_id, name_info["error"]))
                     api_responses.append(name_info["api_response"])
             logger.info("模糊查詢路段 ID: {}，路段名稱: {}，分組: {}".format(segment_ids, segment_names, segment_groups))
 
-        spot_data = self._get_parking_spots(city, segment_ids, spot_number)
+        spot_data = self._get_parking_spots(city, segment_ids, spot_number, query)
         if isinstance(spot_data, dict) and "error" in spot_data:
             error_msgs.append("無法查詢 {} 的車位資料：{}。".format(
                 remaining_address, spot_data["error"]))
             api_responses.append(spot_data["api_response"])
-            response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-            return response_text, error_msgs, api_responses, available_spot_ids
+            return self._error_result(error_msgs, api_responses, query.api_calls)
+        return self._build_grouped_response(remaining_address, segment_ids, segment_groups, segment_names, spot_data,
+                                            error_msgs, api_responses, query.api_calls)
+
+    def _error_result(self, error_msgs, api_responses, api_call_count):
+        """未取得車格資料時的查詢結果。"""
+        return {
+            "response_text": "此次查詢共呼叫 {} 次 API\n".format(api_call_count),
+            "error_msgs": error_msgs,
+            "api_responses": api_responses,
+            "available_spot_ids": set(),
+            "segments": [],
+            "collect_times": {},
+            "ok": False,
+            "stale_age": None
+        }
+
+    def is_alias(self, address):
+        """地址（可含縣市名稱或為「回家」）是否對應 address_to_segment 中的固定地址，不呼叫 API。"""
+        _, remaining_address, address_error = self._normalize_address(address)
+        return address_error is None and remaining_address in address_to_segment
+
+    def _normalize_address(self, address):
+        """驗證地址並換算城市，返回 (city, remaining_address, error_msg)；地址無效時 error_msg 不為 None。"""
+        if not isinstance(address, str):
+            logger.error("地址輸入無效: 必須是字串，收到 {}".format(type(address)))
+            return None, None, "地址輸入無效，請提供有效的地址字串（例如：停車 青年公園）"
+
+        # 若地址為「回家」，使用環境變數 HOME_ADDRESS
+        if address.lower() == "回家":
+            address = self.home_address
+            logger.info("使用 HOME_ADDRESS: {}".format(address))
 
+        city, remaining_address = self._map_city(address)
+        if not remaining_address:
+            return city, remaining_address, "地址輸入無效，請提供具體的路段或集合名稱（例如：青年公園）"
+        return city, remaining_address, None
+
+    def _resolve_alias_segments(self, remaining_address):
+        """由 address_to_segment 取得路段 ID、分組與名稱，不需呼叫 API。"""
+        segment_ids = []
+        segment_groups = {}
+        logger.info("地址 {} 在 address_to_segment 中，提取路段 ID".format(remaining_address))
+        for item in address_to_segment[remaining_address]:
+            if ":" in item["id"]:
+                seg_id, group_name = item["id"].split(":")
+                segment_ids.append(seg_id)
+                segment_groups[seg_id] = segment_groups.get(seg_id, []) + [group_name]
+            else:
+                segment_ids.append(item["id"])
+                segment_groups[item["id"]] = [g["name"] for g in group_config.get(item["id"], [])]
+        # 優先使用 address_to_segment 的名稱
+        segment_names = {}
+        for item in address_to_segment[remaining_address]:
+            seg_id = item["id"].split(":")[0] if ":" in item["id"] else item["id"]
+            segment_names[seg_id] = item["name"]
+        logger.info("提取的路段 ID: {}，路段名稱: {}，分組: {}".format(segment_ids, segment_names, segment_groups))
+        return segment_ids, segment_groups, segment_names
+
+    def _build_grouped_response(self, remaining_address, segment_ids, segment_groups, segment_names, spot_data,
+                                error_msgs, api_responses, api_call_count):
+        """依 group_config 將動態車格資料分組並產生回應文字與結構化資料，返回查詢結果 dict。"""
+        response_text = ""
+        available_spot_ids = set()
         segment_spots = {}
+        segments = []
+        result = {
+            "error_msgs": error_msgs,
+            "api_responses": api_responses,
+            "available_spot_ids": available_spot_ids,
+            "segments": segments,
+            "collect_times": spot_data.get("collect_times", {}),
+            "ok": True,
+            "stale_age": None
+        }
         current_time = datetime.now(timezone.utc)
         for spot in spot_data.get("CurbSpotParkingAvailabilities", []):
             segment_id = spot.get("ParkingSegmentID")
@@ -496,7 +885,8 @@ class ParkingFinder:
             segment_spots[segment_id]["groups"][group_name]["spots"].append({
                 "number": spot_number,
                 "status": status_name,
-                "minutes_ago": minutes_ago
+                "minutes_ago": minutes_ago,
+                "collect_time": collect_time
             })
             segment_spots[segment_id]["groups"][group_name]["count"] += 1
             segment_spots[segment_id]["total_count"] += 1
@@ -510,8 +900,9 @@ class ParkingFinder:
                     api_responses.append({seg_id: spot_data["api_responses"][seg_id]})
             if not segment_spots or all(info["total_count"] == 0 for info in segment_spots.values()):
                 error_msgs.append("目前 {} 真的沒有空車位，請稍後再試。".format(remaining_address))
-                response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-                return response_text, error_msgs, api_responses, available_spot_ids
+                response_text += "此次查詢共呼叫 {} 次 API\n".format(api_call_count)
+                result["response_text"] = response_text
+                return result
 
         response_text = " {} 的車位狀態資訊：\n".format(remaining_address)
         sorted_segments = sorted(segment_spots.items(), key=lambda x: x[1]["total_count"], reverse=True)
@@ -520,11 +911,15 @@ class ParkingFinder:
                 logger.info("路段 {} ({}) 無符合 group_config 的空車位".format(segment_id, segment_info["name"]))
                 continue
             response_text += "路段: {}\n".format(segment_info["name"])
+            groups = []
+            segments.append({"id": segment_id, "name": segment_info["name"], "total_count": segment_info["total_count"],
+                             "groups": groups})
             sorted_groups = sorted(segment_info["groups"].items(), key=lambda x: x[1]["count"], reverse=True)
             for group_name, group_info in sorted_groups:
                 sorted_spots = sorted(group_info["spots"],
                                       key=lambda x: int(re.search(r'\d+', x["number"]).group()) if re.search(r'\d+', x[
                                           "number"]) else 0)
+                groups.append({"name": group_name, "count": group_info["count"], "spots": sorted_spots})
                 spot_texts = []
                 for spot in sorted_spots:
                     spot_texts.append(
@@ -532,12 +927,15 @@ class ParkingFinder:
                 response_text += "  {}，空車位數量: {}，車格狀態: {}\n".format(group_name, group_info["count"],
                                                                              ", ".join(spot_texts))
 
-        response_text += "此次查詢共呼叫 {} 次 API\n".format(self.api_call_count)
-        return response_text, error_msgs, api_responses, available_spot_ids
+        response_text += "此次查詢共呼叫 {} 次 API\n".format(api_call_count)
+        result["response_text"] = response_text
+        return result
 
+    @profiler.profile("monitor_parking_spots")
     async def monitor_parking_spots(self, address, user_id, max_duration=600):
         """
-        監控指定地址的停車位，每 5 秒查詢一次，直到發現新空車格（在 group_config 範圍內），推送訊息後結束。
+        監控指定地址的停車位，直到發現新空車格（在 group_config 範圍內），推送訊息後結束。
+        輪詢時間由 AdaptivePollScheduler 依路段 DataCollectTime 的更新週期決定。
 
         Args:
             address (str): 查詢地址（例如 "回家" 或 "青年公園"）
@@ -548,10 +946,21 @@ class ParkingFinder:
             None（推送訊息後結束）
         """
         logger.info("開始監控停車位，地址: {}，用戶 ID: {}".format(address, user_id))
+        if not self.fair_scheduler.start_monitor(user_id):
+            self.line_bot_api.push_message(user_id, TextSendMessage(
+                text="監控失敗：同時最多 {} 個監控，請等待目前的監控結束".format(self.fair_scheduler.max_monitors)))
+            logger.warning("用戶 {} 監控數已達上限，地址: {}".format(user_id, address))
+            return
+        try:
+            with self.fair_scheduler.as_user(user_id):
+                await self._monitor_parking_spots(address, user_id, max_duration)
+        finally:
+            self.fair_scheduler.end_monitor(user_id)
 
+    async def _monitor_parking_spots(self, address, user_id, max_duration):
         # 首次查詢，記錄初始空車格
-        initial_response, initial_errors, initial_api_responses, initial_spot_ids = self.find_grouped_parking_spots(
-            address)
+        initial_data = await self.async_finder.find_grouped_parking_data(address)
+        initial_response, initial_errors, initial_api_responses, initial_spot_ids = self.as_tuple(initial_data)
         if initial_errors:
             error_msg = "\n".join(initial_errors)
             self.line_bot_api.push_message(user_id, TextSendMessage(text="監控失敗：{}".format(error_msg)))
@@ -562,9 +971,15 @@ class ParkingFinder:
 
         # 監控迴圈
         start_time = time.time()
-        while time.time() - start_time < max_duration:
-            await asyncio.sleep(5)  # 每 5 秒查詢一次
-            response, errors, api_responses, current_spot_ids = self.find_grouped_parking_spots(address)
+        scheduler = AdaptivePollScheduler(max_duration, initial_data["collect_times"])
+        while True:
+            delay = scheduler.next_delay()
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            data = await self.async_finder.find_grouped_parking_data(address)
+            response, errors, api_responses, current_spot_ids = self.as_tuple(data)
+            scheduler.observe(data["collect_times"])
             if errors:
                 logger.warning("監控查詢失敗，地址: {}，錯誤: {}".format(address, errors))
                 continue
@@ -575,7 +990,7 @@ class ParkingFinder:
                 logger.info("發現新增空車格: {}".format(new_spot_ids))
                 # 動態查詢新車格的路段名稱
                 segment_ids = list(set([spot_id[:len(spot_id) - 3] for spot_id in new_spot_ids]))
-                segment_names = self._get_segment_names(self.home_city, segment_ids)
+                segment_names = await self.async_finder.get_segment_names(self.home_city, segment_ids)
                 new_response = ""
                 for spot_id in new_spot_ids:
                     segment_id = next((seg_id for seg_id in segment_ids if spot_id.startswith(seg_id)), None)
@@ -596,6 +1011,8 @@ class ParkingFinder:
                     self.line_bot_api.push_message(user_id,
                                                    TextSendMessage(text="發現新增空車位：\n{}".format(new_response)))
                     logger.info("已推送新增空車位訊息，地址: {}，車格: {}".format(address, new_spot_ids))
+                    logger.info("監控輪詢 {} 次，較固定每 {} 秒輪詢節省 {} 次".format(
+                        scheduler.polls, FIXED_POLL_INTERVAL, scheduler.polls_saved()))
                     return
                 else:
                     logger.warning("新增車格 {} 不在 group_config 範圍內，忽略".format(new_spot_ids))
@@ -605,4 +1022,6 @@ class ParkingFinder:
         # 超過最大監控時間，推送無新車格訊息
         self.line_bot_api.push_message(user_id, TextSendMessage(
             text="監控結束：{} 在 {} 秒內無新增空車位".format(address, max_duration)))
-        logger.info("監控結束，地址: {}，無新增空車位，總耗時: {} 秒".format(address, time.time() - start_time))
\ No newline at end of file
+        logger.info("監控結束，地址: {}，無新增空車位，總耗時: {} 秒".format(address, time.time() - start_time))
+        logger.info("監控輪詢 {} 次，較固定每 {} 秒輪詢節省 {} 次".format(
+            scheduler.polls, FIXED_POLL_INTERVAL, scheduler.polls_saved()))
\ No newline at end of file
@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+from datetime import datetime
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 監控輪詢間隔上下限（秒）；原本固定每 5 秒輪詢一次，作為節省次數的比較基準
+MONITOR_MIN_INTERVAL = float(os.getenv("MONITOR_MIN_INTERVAL", default=5))
+MONITOR_MAX_INTERVAL = float(os.getenv("MONITOR_MAX_INTERVAL", default=60))
+FIXED_POLL_INTERVAL = 5
+
+
+class AdaptivePollScheduler:
+    """
+    依路段 DataCollectTime 的更新週期決定下一次輪詢時間。
+
+    每個路段觀察到 DataCollectTime 前進時，以兩次資料時間的差估計更新週期（指數平滑），
+    並以觀察到的最小發布延遲（發現時間 - DataCollectTime）推估資料何時可查得，
+    下一次輪詢排在預期更新之後 margin 秒；尚未學到週期或預期更新已過仍無變化時指數退避。
+    接近監控結束時間時逐步縮短間隔，避免錯過最後幾次更新。
+    """
+
+    def __init__(self, window, collect_times=None, min_interval=MONITOR_MIN_INTERVAL,
+                 max_interval=MONITOR_MAX_INTERVAL, margin=1.0, smoothing=0.5):
+        self.window = window
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.margin = margin
+        self.smoothing = smoothing
+        self.started_at = time.time()
+        self.segments = {}
+        self.misses = 0
+        self.polls = 0
+        self._update_segments(collect_times or {}, self.started_at)
+
+    def _update_segments(self, collect_times, now):
+        changed = False
+        for seg_id, collect_time in collect_times.items():
+            try:
+                collect_dt = datetime.fromisoformat(collect_time.replace('Z', '+00:00'))
+            except (AttributeError, ValueError):
+                logger.warning("路段 {} 的 DataCollectTime 格式無效: {}".format(seg_id, collect_time))
+                continue
+            lag = now - collect_dt.timestamp()
+            state = self.segments.get(seg_id)
+            if state is None:
+                self.segments[seg_id] = {"collect_time": collect_dt, "lag": lag, "interval": None}
+                continue
+            if collect_dt <= state["collect_time"]:
+                continue
+            observed = (collect_dt - state["collect_time"]).total_seconds()
+            if state["interval"] is None:
+                state["interval"] = observed
+            else:
+                state["interval"] = self.smoothing * observed + (1 - self.smoothing) * state["interval"]
+            state["collect_time"] = collect_dt
+            state["lag"] = min(state["lag"], lag)
+            changed = True
+        return changed
+
+    def observe(self, collect_times, now=None):
+        """記錄一次輪詢取得的 {路段 ID: DataCollectTime}，返回是否有路段資料更新。"""
+        now = time.time() if now is None else now
+        self.polls += 1
+        changed = self._update_segments(collect_times, now)
+        self.misses = 0 if changed else self.misses + 1
+        return changed
+
+    def next_delay(self, now=None):
+        """返回距離下一次輪詢的秒數；監控時間已結束時返回 None。"""
+        now = time.time() if now is None else now
+        remaining = self.window - (now - self.started_at)
+        if remaining <= 0:
+            return None
+        upcoming = [state["collect_time"].timestamp() + state["lag"] + state["interval"] - now
+                    for state in self.segments.values() if state["interval"]]
+        upcoming = [delay for delay in upcoming if delay > 0]
+        if upcoming:
+            # 排在最早一個路段預期更新之後
+            delay = min(upcoming) + self.margin
+        else:
+            # 尚未學到週期或預期更新已過：無變化時指數退避
+            delay = self.min_interval * (2 ** min(self.misses, 16))
+        delay = max(self.min_interval, min(delay, self.max_interval))
+        # 接近監控結束時縮短間隔
+        delay = min(delay, max(self.min_interval, remaining / 3))
+        return min(delay, remaining)
+
+    def polls_saved(self, now=None):
+        """與原本固定每 5 秒輪詢相比，節省的輪詢次數。"""
+        now = time.time() if now is None else now
+        fixed_polls = int((now - self.started_at) // FIXED_POLL_INTERVAL)
+        return fixed_polls - self.polls
@@ -0,0 +1,302 @@
+import os
+import time
+import logging
+import threading
+import requests
+from urllib.parse import quote
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from api.config import address_to_segment
+from api.batching import plan_batches
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 預熱過的地址在此秒數內的查詢直接使用預熱資料
+PREFETCH_WARM_MAX_AGE = int(os.getenv("PREFETCH_WARM_MAX_AGE", default=90))
+# 預熱每小時最多使用的 TDX 呼叫數，避免吃掉查詢配額
+PREFETCH_HOURLY_BUDGET = int(os.getenv("PREFETCH_HOURLY_BUDGET", default=180))
+# 排程呼叫 /api/warmup 的間隔秒數（需與 vercel.json 的 crons 一致），每次預熱最多使用
+# PREFETCH_HOURLY_BUDGET * PREFETCH_INTERVAL / 3600 次呼叫，不需跨實例記錄已用額度
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", default=60))
+# 沒有查詢統計時也會預熱的固定地址，以逗號分隔
+PREFETCH_ADDRESSES = os.getenv("PREFETCH_ADDRESSES", default="回家,回家計次,青年公園")
+# 透過 CDN 預熱時的站台網址：預熱時請求此站台的 /api/parking/<地址>，更新各實例共用的 CDN 快取；
+# Vercel 上預設為正式網域，未設定時在本行程內預熱（適用常駐的單一行程部署）
+PREFETCH_BASE_URL = os.getenv("PREFETCH_BASE_URL", default="https://{}".format(
+    os.getenv("VERCEL_PROJECT_PRODUCTION_URL")) if os.getenv("VERCEL_PROJECT_PRODUCTION_URL") else "")
+# 預熱請求帶上此標頭，/api/parking 不把它記為用戶查詢
+PREFETCH_HEADER = "X-Prefetch"
+# 每次預熱最多更新的地址數
+PREFETCH_MAX_ADDRESSES = int(os.getenv("PREFETCH_MAX_ADDRESSES", default=5))
+# 預測時段內平均每天至少被查詢幾次才預熱
+PREFETCH_MIN_DAILY_HITS = float(os.getenv("PREFETCH_MIN_DAILY_HITS", default=1))
+# 最多記錄的地址數，超過時捨棄查詢次數最少的
+USAGE_MAX_ADDRESSES = int(os.getenv("USAGE_MAX_ADDRESSES", default=200))
+# Vercel KV（Upstash Redis REST API）；設定後查詢統計存於 KV，所有 serverless 實例共用
+KV_REST_API_URL = os.getenv("KV_REST_API_URL")
+KV_REST_API_TOKEN = os.getenv("KV_REST_API_TOKEN")
+USAGE_KV_KEY = os.getenv("USAGE_KV_KEY", default="lbot:usage")
+
+# 使用者所在時區（台灣），時段統計依當地時間
+LOCAL_TZ = timezone(timedelta(hours=8))
+
+
+class KVUsageStore:
+    """
+    以 Upstash Redis REST API（Vercel KV）保存各固定地址每小時的查詢次數，所有實例共用。
+
+    全部統計存在一個 hash：欄位 "<小時>|<地址>" 為查詢次數，"started_at" 為開始統計的時間。
+    """
+
+    def __init__(self, url, token, key=USAGE_KV_KEY, timeout=1):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.key = key
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls):
+        """有設定 KV_REST_API_URL 與 KV_REST_API_TOKEN 時返回 KVUsageStore，否則返回 None。"""
+        if KV_REST_API_URL and KV_REST_API_TOKEN:
+            return cls(KV_REST_API_URL, KV_REST_API_TOKEN)
+        return None
+
+    def _pipeline(self, commands):
+        response = requests.post("{}/pipeline".format(self.url), json=commands, timeout=self.timeout,
+                                 headers={"Authorization": "Bearer {}".format(self.token)})
+        response.raise_for_status()
+        return [item.get("result") for item in response.json()]
+
+    def record(self, address, hour, now):
+        self._pipeline([["HINCRBY", self.key, "{}|{}".format(hour, address), 1],
+                        ["HSETNX", self.key, "started_at", str(now)]])
+
+    def load(self):
+        """返回 (開始統計的時間, {地址: 24 小時的查詢次數})。"""
+        result = self._pipeline([["HGETALL", self.key]])[0] or []
+        fields = dict(zip(result[::2], result[1::2]))
+        started_at = float(fields.pop("started_at", time.time()))
+        hourly = {}
+        for field, count in fields.items():
+            hour, _, address = field.partition("|")
+            hourly.setdefault(address, [0] * 24)[int(hour)] += int(count)
+        return started_at, hourly
+
+
+class UsageTracker:
+    """
+    記錄各地址的查詢次數與一天中各小時的查詢分布，用來預測接下來會被查詢的地址。
+
+    有 store（KVUsageStore）時固定地址的統計另存於 KV，預測改用 KV 中所有實例的統計；
+    KV 無法連線時記錄警告並改用本行程的統計。
+    """
+
+    def __init__(self, max_addresses=USAGE_MAX_ADDRESSES, store=None):
+        self.max_addresses = max_addresses
+        self.store = store
+        self.totals = {}
+        self.hourly = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, address, now=None):
+        if not isinstance(address, str) or not address:
+            return
+        now = time.time() if now is None else now
+        hour = datetime.fromtimestamp(now, LOCAL_TZ).hour
+        # KV 只記錄固定地址（也只有固定地址會被預熱），欄位數有上限
+        if self.store is not None and address in address_to_segment:
+            try:
+                self.store.record(address, hour, now)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning("查詢統計寫入 KV 失敗: {}".format(str(e)))
+        with self._lock:
+            if address not in self.totals and len(self.totals) >= self.max_addresses:
+                coldest = min(self.totals, key=self.totals.get)
+                del self.totals[coldest]
+                del self.hourly[coldest]
+            self.totals[address] = self.totals.get(address, 0) + 1
+            self.hourly.setdefault(address, [0] * 24)[hour] += 1
+
+    def hot_addresses(self, now=None, min_daily_hits=PREFETCH_MIN_DAILY_HITS):
+        """
+        預測接下來一小時內會被查詢的地址。
+
+        Returns:
+            list: (address, score) 依 score 由高到低排序；score 為目前與下一個小時
+                在過去平均每天的查詢次數，只列出 score >= min_daily_hits 的地址
+        """
+        now = time.time() if now is None else now
+        hour = datetime.fromtimestamp(now, LOCAL_TZ).hour
+        started_at, hourly = self._load()
+        days = max(1.0, (now - started_at) / 86400)
+        scores = [(address, (counts[hour] + counts[(hour + 1) % 24]) / days) for address, counts in hourly.items()]
+        return sorted([item for item in scores if item[1] >= min_daily_hits], key=lambda x: x[1], reverse=True)
+
+    def _load(self):
+        if self.store is not None:
+            try:
+                return self.store.load()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning("讀取 KV 查詢統計失敗，改用本行程的統計: {}".format(str(e)))
+        with self._lock:
+            return self.started_at, {address: list(counts) for address, counts in self.hourly.items()}
+
+    def snapshot(self):
+        with self._lock:
+            return {address: {"total": total, "hourly": list(self.hourly[address])}
+                    for address, total in self.totals.items()}
+
+
+class Prefetcher:
+    """
+    依 UsageTracker 的預測與 PREFETCH_ADDRESSES，在排程觸發時提前更新熱門固定地址的車位資料。
+
+    設定 base_url（Vercel 上預設為正式網域）時，預熱請求站台自己的 /api/parking/<地址>，
+    回應帶 s-maxage 與 stale-while-revalidate，由所有實例共用的 CDN 快取，之後的 JSON 查詢
+    直接由 CDN 回應；未設定時在本行程內查詢（各地址由 SpotBatchPlanner 合併成共用批次），
+    寫入 ParkingFinder 的最後成功結果，之後 PREFETCH_WARM_MAX_AGE 秒內的查詢直接使用預熱資料。
+
+    每次預熱最多使用 hourly_budget * interval / 3600 次 TDX 呼叫，不需跨實例記錄已用額度；
+    同一行程內另外以最近一小時的實際用量限制，手動重複呼叫也不會超過 hourly_budget。
+    """
+
+    def __init__(self, finder, tracker, warm_max_age=PREFETCH_WARM_MAX_AGE, hourly_budget=PREFETCH_HOURLY_BUDGET,
+                 max_addresses=PREFETCH_MAX_ADDRESSES, interval=PREFETCH_INTERVAL, addresses=PREFETCH_ADDRESSES,
+                 base_url=PREFETCH_BASE_URL):
+        self.finder = finder
+        self.tracker = tracker
+        self.warm_max_age = warm_max_age
+        self.hourly_budget = hourly_budget
+        self.max_addresses = max_addresses
+        self.run_budget = max(1, int(hourly_budget * interval / 3600))
+        self.addresses = [address.strip() for address in addresses.split(",") if address.strip()]
+        self.base_url = base_url.rstrip("/")
+        self.warm_hits = 0
+        self._warmed = set()
+        self._spent = deque()
+        self._lock = threading.Lock()
+
+    def find_grouped_parking_data(self, address, spot_number=None):
+        """記錄查詢並呼叫 ParkingFinder.find_grouped_parking_data；本行程預熱過的地址優先使用預熱資料。"""
+        self.tracker.record(address)
+        if spot_number is None and address in self._warmed:
+            with self.finder._stale_lock:
+                entry = self.finder.last_good_results.get((address, None))
+            age = int(time.time() - entry[0]) if entry is not None else None
+            if age is not None and age <= self.warm_max_age:
+                with self._lock:
+                    self.warm_hits += 1
+                logger.info("使用預熱資料回應，地址: {}".format(address))
+                return self.finder._annotated_copy(entry[1], age, "預熱資料")
+        return self.finder.find_grouped_parking_data(address, spot_number)
+
+    def find_grouped_parking_spots(self, address, spot_number=None):
+        return self.finder.as_tuple(self.find_grouped_parking_data(address, spot_number))
+
+    def budget_remaining(self, now=None):
+        """此次預熱可用的 TDX 呼叫數。"""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._spent and self._spent[0][0] <= now - 3600:
+                self._spent.popleft()
+            return min(self.run_budget, self.hourly_budget - sum(cost for _, cost in self._spent))
+
+    def _alias_segments(self, address):
+        """返回 (city, 路段 ID)；不是 address_to_segment 中的固定地址時返回 None。"""
+        city, remaining_address, address_error = self.finder._normalize_address(address)
+        if address_error or remaining_address not in address_to_segment:
+            return None
+        return city, [item["id"].split(":")[0] for item in address_to_segment[remaining_address]]
+
+    def _estimate_cost(self, selected):
+        """實際送出的動態車格批次數：本行程預熱時同城市的地址會合併，經由 CDN 預熱時各地址分別查詢。"""
+        if self.base_url:
+            return sum(len(plan_batches([segment_ids])) for _, _, segment_ids in selected)
+        by_city = {}
+        for _, city, segment_ids in selected:
+            by_city.setdefault(city, []).append(segment_ids)
+        return sum(len(plan_batches(demands)) for demands in by_city.values())
+
+    def _candidates(self, now):
+        """預測的熱門地址在前，再加上 PREFETCH_ADDRESSES 中尚未列出的地址。"""
+        addresses = [address for address, _ in self.tracker.hot_addresses(now)]
+        return addresses + [address for address in self.addresses if address not in addresses]
+
+    def warm(self, now=None):
+        """
+        預熱接下來可能被查詢的地址，供排程路由呼叫。
+
+        Returns:
+            dict: warmed（已更新的地址）、skipped（略過的地址與原因）、cost（使用的 TDX 呼叫數）
+                與 budget_remaining（預熱後同一行程仍可使用的額度）
+        """
+        now = time.time() if now is None else now
+        report = {"warmed": [], "skipped": {}, "cost": 0}
+        selected = []
+        remaining = self.budget_remaining(now)
+        for address in self._candidates(now):
+            alias = self._alias_segments(address)
+            if alias is None:
+                report["skipped"][address] = "非固定地址"
+                continue
+            if not self.finder._upstream_healthy(address):
+                report["skipped"][address] = "TDX 服務異常"
+                continue
+            if not self.base_url:
+                with self.finder._stale_lock:
+                    entry = self.finder.last_good_results.get((address, None))
+                # 資料還夠新（例如剛被使用者查詢過）就不重複查詢
+                if entry is not None and now - entry[0] <= self.warm_max_age / 2:
+                    self._warmed.add(address)
+                    report["skipped"][address] = "資料仍新"
+                    continue
+            if len(selected) >= self.max_addresses or self._estimate_cost(selected + [(address,) + alias]) > remaining:
+                report["skipped"][address] = "超過預熱額度"
+                continue
+            selected.append((address,) + alias)
+
+        if selected:
+            cost = self._estimate_cost(selected)
+            with self._lock:
+                self._spent.append((now, cost))
+            succeeded = []
+            warm_one = self._warm_via_cdn if self.base_url else self._warm_one
+            threads = [threading.Thread(target=warm_one, args=(address, succeeded), daemon=True)
+                       for address, _, _ in selected]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report["warmed"] = succeeded
+            report["cost"] = cost
+            logger.info("預熱 {} 個地址，使用 {} 次 TDX 呼叫：{}".format(len(report["warmed"]), cost, report["warmed"]))
+        report["budget_remaining"] = self.budget_remaining(now)
+        return report
+
+    def _warm_one(self, address, succeeded):
+        try:
+            result = self.finder.find_grouped_parking_data(address)
+        except Exception as e:
+            logger.warning("預熱失敗，地址: {}，錯誤: {}".format(address, str(e)))
+            return
+        if result["ok"] and result["stale_age"] is None:
+            self._warmed.add(address)
+            succeeded.append(address)
+        else:
+            logger.warning("預熱失敗，地址: {}，錯誤: {}".format(address, result["error_msgs"]))
+
+    def _warm_via_cdn(self, address, succeeded):
+        """請求站台的 /api/parking/<地址>，由處理請求的實例查詢 TDX，回應存入共用的 CDN 快取。"""
+        url = "{}/api/parking/{}".format(self.base_url, quote(address, safe=""))
+        try:
+            response = requests.get(url, headers={PREFETCH_HEADER: "1"}, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.warning("預熱失敗，地址: {}，錯誤: {}".format(address, str(e)))
+            return
+        if response.status_code == 200:
+            succeeded.append(address)
+        else:
+            logger.warning("預熱失敗，地址: {}，HTTP {}".format(address, response.status_code))
@@ -0,0 +1,113 @@
+import os
+import io
+import time
+import glob
+import random
+import pstats
+import cProfile
+import logging
+import asyncio
+import threading
+import functools
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 抽樣比例（0 為關閉）、輸出目錄（Vercel 僅 /tmp 可寫）、最多保留的檔案數與摘要列出的函式數
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", default=0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", default="/tmp/lbot-profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", default=20))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", default=15))
+
+
+class Profiler:
+    """
+    依抽樣比例以 cProfile 分析被裝飾函式的執行，將 .prof 檔寫到 PROFILE_DIR（超過上限刪除最舊的），
+    並記錄耗時最多的前 N 個函式。
+
+    sample_rate 為 0 時裝飾器只多一次數值比較。同一時間只分析一次執行，其餘直接略過；
+    分析 async 函式時，同一事件迴圈中其他任務的執行也會算在這次的結果內。
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, output_dir=PROFILE_DIR, max_files=PROFILE_MAX_FILES,
+                 top_n=PROFILE_TOP_N):
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.top_n = top_n
+        self.last_summary = ""
+        self._active = threading.Lock()
+        self._dump_lock = threading.Lock()
+
+    def set_sample_rate(self, sample_rate):
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        logger.info("效能分析抽樣比例設為 {}".format(self.sample_rate))
+
+    def _start(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        # cProfile 無法同時啟用多個，忙碌時略過這次抽樣
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _finish(self, name, profile, start_time):
+        profile.disable()
+        self._active.release()
+        elapsed = time.time() - start_time
+        try:
+            with self._dump_lock:
+                self._dump(name, profile)
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(self.top_n)
+            self.last_summary = "{}，耗時 {:.3f} 秒\n{}".format(name, elapsed, stream.getvalue())
+            logger.info("效能分析結果：{}".format(self.last_summary))
+        except Exception as e:
+            logger.error("效能分析結果輸出失敗: {}".format(str(e)))
+
+    def _dump(self, name, profile):
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, "{}-{}-{}.prof".format(name, int(time.time() * 1000), os.getpid()))
+        profile.dump_stats(path)
+        # 只保留最新的 max_files 個檔案
+        dumps = sorted(glob.glob(os.path.join(self.output_dir, "*.prof")), key=os.path.getmtime)
+        for old_path in dumps[:max(0, len(dumps) - self.max_files)]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def profile(self, name):
+        """裝飾同步或 async 函式，依抽樣比例分析其執行。"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    profile = self._start()
+                    if profile is None:
+                        return await func(*args, **kwargs)
+                    start_time = time.time()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self._finish(name, profile, start_time)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                profile = self._start()
+                if profile is None:
+                    return func(*args, **kwargs)
+                start_time = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._finish(name, profile, start_time)
+            return wrapper
+        return decorator
+
+
+profiler = Profiler()
@@ -0,0 +1,186 @@
+import os
+import json
+import queue
+import logging
+import threading
+from api.polling import AdaptivePollScheduler
+
+# 設置日誌記錄，方便除錯
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 每個連線最多暫存的事件數，超過時清空並改送一次完整快照
+STREAM_CLIENT_BUFFER = int(os.getenv("STREAM_CLIENT_BUFFER", default=100))
+# 無事件時送出 keep-alive 註解的間隔（秒）
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", default=15))
+
+
+def format_sse(event, data, event_id=None):
+    """將事件轉為 Server-Sent Events 格式。"""
+    lines = []
+    if event_id is not None:
+        lines.append("id: {}".format(event_id))
+    lines.append("event: {}".format(event))
+    lines.append("data: {}".format(json.dumps(data, ensure_ascii=False, separators=(",", ":"))))
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription:
+    """一個 SSE 連線的訂閱，持有有上限的事件佇列；segment_id 不為 None 時只接收該路段的事件。"""
+
+    def __init__(self, topic, segment_id=None, buffer_size=STREAM_CLIENT_BUFFER):
+        self.topic = topic
+        self.segment_id = segment_id
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def wants(self, spot):
+        return self.segment_id is None or spot["segment_id"] == self.segment_id
+
+    def offer(self, message, snapshot):
+        """放入事件；佇列已滿（連線消化太慢）時丟棄暫存事件，改放一次完整快照讓用戶端重新同步。"""
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            dropped = 0
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    dropped += 1
+                except queue.Empty:
+                    break
+            self.dropped += dropped
+            logger.warning("SSE 連線消化太慢，丟棄 {} 個事件並重送快照，地址: {}".format(dropped, self.topic.address))
+            self.queue.put_nowait(snapshot())
+
+    def events(self, keepalive=STREAM_KEEPALIVE):
+        """產生要送給用戶端的 SSE 字串；連線中斷時自動取消訂閱。"""
+        try:
+            yield self.topic.snapshot_message(self)
+            while True:
+                try:
+                    yield self.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            self.topic.unsubscribe(self)
+
+
+class SpotChangeTopic:
+    """
+    單一地址的共用輪詢：不論有多少連線都只有一個背景執行緒查詢 TDX，
+    比對前後兩次的空車格，將空出（free）與被占用（occupied）的車格事件分送給所有訂閱者。
+    """
+
+    def __init__(self, hub, address):
+        self.hub = hub
+        self.address = address
+        self.subscribers = set()
+        self.spots = {}
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self, segment_id=None):
+        subscription = Subscription(self, segment_id)
+        with self._lock:
+            self.subscribers.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        logger.info("新增 SSE 訂閱，地址: {}，路段: {}，訂閱數: {}".format(
+            self.address, segment_id, len(self.subscribers)))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+            if not self.subscribers:
+                self._wakeup.set()
+        logger.info("取消 SSE 訂閱，地址: {}，剩餘訂閱數: {}".format(self.address, len(self.subscribers)))
+
+    def snapshot_message(self, subscription):
+        with self._lock:
+            return self._snapshot(subscription)
+
+    def _snapshot(self, subscription):
+        spots = [spot for spot in self.spots.values() if subscription.wants(spot)]
+        return format_sse("snapshot", {"address": self.address, "spots": spots}, self.seq)
+
+    def _run(self):
+        scheduler = None
+        while True:
+            try:
+                data = self.hub.finder.find_grouped_parking_data(self.address, max_age=self.hub.max_age)
+            except Exception as e:
+                logger.error("SSE 輪詢失敗，地址: {}，錯誤: {}".format(self.address, str(e)))
+                data = None
+            if data is not None and data["ok"]:
+                self._publish(data)
+            if scheduler is None:
+                scheduler = AdaptivePollScheduler(float("inf"), data["collect_times"] if data else {})
+            else:
+                scheduler.observe(data["collect_times"] if data else {})
+            self._wakeup.wait(scheduler.next_delay())
+            with self._lock:
+                self._wakeup.clear()
+                if self.subscribers:
+                    continue
+                # 最後一個訂閱者離開，停止輪詢
+                self._thread = None
+            logger.info("停止 SSE 輪詢，地址: {}，節省輪詢 {} 次".format(self.address, scheduler.polls_saved()))
+            self.hub.remove_topic(self)
+            return
+
+    def _publish(self, data):
+        current = {}
+        for segment in data["segments"]:
+            for group in segment["groups"]:
+                for spot in group["spots"]:
+                    current["{}:{}".format(segment["id"], spot["number"])] = {
+                        "segment_id": segment["id"],
+                        "segment_name": segment["name"],
+                        "group": group["name"],
+                        "number": spot["number"],
+                        "collect_time": spot["collect_time"]
+                    }
+        with self._lock:
+            changes = [("free", spot) for key, spot in current.items() if key not in self.spots]
+            changes += [("occupied", spot) for key, spot in self.spots.items() if key not in current]
+            self.spots = current
+            subscribers = list(self.subscribers)
+            for event, spot in changes:
+                self.seq += 1
+                message = format_sse(event, dict(spot, status=event), self.seq)
+                for subscription in subscribers:
+                    if subscription.wants(spot):
+                        subscription.offer(message, lambda s=subscription: self._snapshot(s))
+        if changes:
+            logger.info("SSE 推送 {} 個車格變化給 {} 個連線，地址: {}".format(len(changes), len(subscribers), self.address))
+
+
+class SpotChangeHub:
+    """依地址管理共用輪詢的 SpotChangeTopic，有訂閱者時才輪詢。"""
+
+    def __init__(self, finder, max_age=0):
+        self.finder = finder
+        self.max_age = max_age
+        self.topics = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, address, segment_id=None):
+        # 每個地址都會啟動一個輪詢執行緒，只接受 address_to_segment 中的固定地址
+        if not self.finder.is_alias(address):
+            raise ValueError("未知的地址: {}".format(address))
+        with self._lock:
+            topic = self.topics.get(address)
+            if topic is None:
+                topic = self.topics[address] = SpotChangeTopic(self, address)
+            return topic.subscribe(segment_id)
+
+    def remove_topic(self, topic):
+        # 與 subscribe 相同先取 hub 再取 topic 的鎖；移除前若已有新訂閱者重新啟動輪詢則保留
+        with self._lock, topic._lock:
+            if self.topics.get(topic.address) is topic and not topic.subscribers and topic._thread is None:
+                del self.topics[topic.address]
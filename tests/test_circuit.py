@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+os.environ.setdefault("TDX_APP_ID", "test-app")
+os.environ.setdefault("TDX_APP_KEY", "test-key")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-line-token")
+
+from api.parking import ParkingFinder  # noqa: E402
+from api.prefetch import UsageTracker, Prefetcher  # noqa: E402
+
+ALIAS = "明德路337巷"
+FUZZY_ADDRESS = "中山北路"
+RESET_TIMEOUT = 0.05
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = json.dumps(data).encode()
+        self.text = self.content.decode()
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError("{} Server Error".format(self.status_code), response=self)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeTDX:
+    """路段查詢可切換為 500 的假 TDX。"""
+
+    def __init__(self):
+        self.segment_down = False
+        self.segment_requests = 0
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if "token" in url:
+            return FakeResponse({"access_token": "token", "expires_in": 86400})
+        if "ParkingSegment/" in url:
+            self.segment_requests += 1
+            if self.segment_down:
+                return FakeResponse({"Message": "down"}, 500)
+            return FakeResponse({"ParkingSegments": [
+                {"ParkingSegmentID": "S1", "ParkingSegmentName": {"Zh_tw": "中山北路一段"}}]})
+        segment_ids = re.findall(r"'([^']+)'", kwargs["params"]["$filter"].split(" and ")[0])
+        return FakeResponse({"CurbSpotParkingAvailabilities": [
+            {"ParkingSpotID": "{}001".format(seg_id), "ParkingSegmentID": seg_id, "SpotStatus": 2,
+             "DataCollectTime": "2026-10-19T08:00:00+08:00"} for seg_id in segment_ids]})
+
+
+class CircuitRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.tdx = FakeTDX()
+        patch = mock.patch("requests.request", self.tdx.request)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.finder = ParkingFinder()
+        for breaker in self.finder.breakers.values():
+            breaker.reset_timeout = RESET_TIMEOUT
+        # 背景重新查詢結束後才還原 requests，避免對真正的 TDX 送出請求
+        self.addCleanup(self.wait_for_revalidation)
+
+    def wait_for_revalidation(self):
+        deadline = time.time() + 5
+        while self.finder._revalidating and time.time() < deadline:
+            time.sleep(0.01)
+
+    def open_segment_breaker(self):
+        self.assertIsNone(self.finder.find_grouped_parking_data(FUZZY_ADDRESS)["stale_age"])
+        self.tdx.segment_down = True
+        for _ in range(self.finder.breakers["segment"].failure_threshold):
+            self.finder.find_grouped_parking_data(FUZZY_ADDRESS)
+        self.assertEqual(self.finder.breakers["segment"].state, "open")
+
+    def test_alias_query_ignores_unrelated_open_breaker(self):
+        self.assertTrue(self.finder.find_grouped_parking_data(ALIAS)["ok"])
+        self.open_segment_breaker()
+        result = self.finder.find_grouped_parking_data(ALIAS)
+        self.assertTrue(result["ok"])
+        self.assertIsNone(result["stale_age"])
+        # 開路期間的路段查詢回應快取
+        self.assertIsNotNone(self.finder.find_grouped_parking_data(FUZZY_ADDRESS)["stale_age"])
+
+    def test_open_breaker_recovers_after_reset_timeout(self):
+        self.open_segment_breaker()
+        self.tdx.segment_down = False
+        time.sleep(RESET_TIMEOUT * 2)
+        result = self.finder.find_grouped_parking_data(FUZZY_ADDRESS)
+        self.assertTrue(result["ok"])
+        self.assertIsNone(result["stale_age"])
+        self.assertEqual(self.finder.breakers["segment"].state, "closed")
+
+    def test_revalidation_probes_open_endpoint(self):
+        self.open_segment_breaker()
+        self.tdx.segment_down = False
+        requests_before = self.tdx.segment_requests
+        self.finder._revalidate(FUZZY_ADDRESS, None)
+        self.assertGreater(self.tdx.segment_requests, requests_before)
+        self.assertEqual(self.finder.breakers["segment"].state, "closed")
+
+    def test_warm_skips_only_addresses_with_unavailable_endpoints(self):
+        self.open_segment_breaker()
+        tracker = UsageTracker()
+        tracker.record(ALIAS)
+        report = Prefetcher(self.finder, tracker, addresses="", base_url="").warm()
+        self.assertEqual(report["warmed"], [ALIAS])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+import httpx
+
+os.environ.setdefault("TDX_APP_ID", "test-app")
+os.environ.setdefault("TDX_APP_KEY", "test-key")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-line-token")
+
+from api.config import address_to_segment  # noqa: E402
+from api.fairness import SYSTEM_USER  # noqa: E402
+from api.parking import ParkingFinder  # noqa: E402
+
+ALIASES = list(address_to_segment)
+THREADS_PER_ALIAS = 3
+ASYNC_LOOPS = 4
+
+
+def spots_for(spot_filter):
+    segment_ids = re.findall(r"'([^']+)'", spot_filter.split(" and ")[0])
+    return [{"ParkingSpotID": "{}001".format(seg_id), "ParkingSegmentID": seg_id, "SpotStatus": 2,
+             "DataCollectTime": "2026-10-19T08:00:00+08:00"} for seg_id in segment_ids]
+
+
+class FakeResponse:
+    """模擬 requests 的回應，支援串流讀取。"""
+
+    def __init__(self, data):
+        self.status_code = 200
+        self.ok = True
+        self.content = json.dumps(data).encode()
+        self.text = self.content.decode()
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeTDX:
+    """記錄所有上游請求的假 TDX，同時供 requests 與 httpx 使用。"""
+
+    def __init__(self):
+        self.token_requests = 0
+        self.spot_requests = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if "token" in url:
+            with self._lock:
+                self.token_requests += 1
+            return FakeResponse({"access_token": "token", "expires_in": 86400})
+        with self._lock:
+            self.spot_requests += 1
+        return FakeResponse({"CurbSpotParkingAvailabilities": spots_for(kwargs["params"]["$filter"])})
+
+    def handle_async(self, request):
+        if "token" in str(request.url):
+            with self._lock:
+                self.token_requests += 1
+            return httpx.Response(200, json={"access_token": "token", "expires_in": 86400})
+        with self._lock:
+            self.spot_requests += 1
+        return httpx.Response(200, json={"CurbSpotParkingAvailabilities": spots_for(request.url.params["$filter"])})
+
+    @property
+    def total_requests(self):
+        return self.token_requests + self.spot_requests
+
+
+def api_calls(result):
+    return int(re.search(r"此次查詢共呼叫 (\d+) 次 API", result["response_text"]).group(1))
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.tdx = FakeTDX()
+        async_client = httpx.AsyncClient
+        patches = [
+            mock.patch("requests.request", self.tdx.request),
+            mock.patch("httpx.AsyncClient",
+                       lambda **kwargs: async_client(transport=httpx.MockTransport(self.tdx.handle_async), **kwargs))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.finder = ParkingFinder()
+
+    def run_queries(self):
+        """多個執行緒的同步查詢與多個事件迴圈的非同步查詢同時進行，每個查詢使用不同的用戶。"""
+        results = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(len(ALIASES) * THREADS_PER_ALIAS + ASYNC_LOOPS)
+
+        def sync_query(user_id, address):
+            start.wait()
+            try:
+                with self.finder.fair_scheduler.as_user(user_id):
+                    result = self.finder.find_grouped_parking_data(address)
+                with lock:
+                    results.append((user_id, result))
+            except Exception as e:
+                errors.append(e)
+
+        async def async_query(user_id, address):
+            with self.finder.fair_scheduler.as_user(user_id):
+                return user_id, await self.finder.async_finder.find_grouped_parking_data(address)
+
+        async def async_queries(loop_index):
+            return await asyncio.gather(
+                *[async_query("loop{}-{}".format(loop_index, i), address) for i, address in enumerate(ALIASES)])
+
+        def async_loop(loop_index):
+            start.wait()
+            try:
+                loop_results = asyncio.run(async_queries(loop_index))
+                with lock:
+                    results.extend(loop_results)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=sync_query, args=("thread{}-{}".format(n, i), address))
+                   for n in range(THREADS_PER_ALIAS) for i, address in enumerate(ALIASES)]
+        threads += [threading.Thread(target=async_loop, args=(n,)) for n in range(ASYNC_LOOPS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), len(ALIASES) * (THREADS_PER_ALIAS + ASYNC_LOOPS))
+        for _, result in results:
+            self.assertTrue(result["ok"], result["error_msgs"])
+        return results
+
+    def test_token_fetched_once(self):
+        self.run_queries()
+        self.assertEqual(self.tdx.token_requests, 1)
+
+    def test_call_counts_sum_without_batching(self):
+        self.finder.spot_planner.window = 0
+        results = self.run_queries()
+        self.assertEqual(sum(api_calls(result) for _, result in results), self.tdx.total_requests)
+
+    def test_merged_batches_charge_every_user(self):
+        results = self.run_queries()
+        usage = {row["user_id"]: row["total_calls"] for row in self.finder.fair_scheduler.snapshot()}
+        for user_id, result in results:
+            self.assertGreaterEqual(api_calls(result), 1)
+            self.assertEqual(usage[user_id], api_calls(result))
+        # 合併批次以系統用戶送出，每個批次都計入各參與的查詢
+        self.assertEqual(usage[SYSTEM_USER], self.tdx.spot_requests)
+        self.assertLessEqual(self.tdx.spot_requests, sum(api_calls(result) for _, result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import threading
+import unittest
+
+from api.batching import SpotBatchPlanner
+from api.fairness import FairScheduler, SYSTEM_USER, current_user
+
+
+class SharedRequestOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = FairScheduler(max_concurrency=1, weights={"vip": 2.0})
+        self.order = []
+        # 佔用唯一的名額，之後的請求都要排隊
+        self.assertIsNone(self.scheduler._enqueue(lambda: None))
+
+    def enqueue(self, name, user_id=None, shared=None):
+        with self.scheduler.as_user(user_id):
+            if shared is None:
+                waiter = self.scheduler._enqueue(lambda: self.order.append(name))
+            else:
+                with self.scheduler.for_users(shared):
+                    waiter = self.scheduler._enqueue(lambda: self.order.append(name))
+        self.assertIsNotNone(waiter)
+
+    def drain(self):
+        while self.scheduler._queue:
+            self.scheduler._release()
+
+    def test_shared_batch_uses_earliest_participant_tag(self):
+        self.scheduler.charge(10, "heavy")
+        self.enqueue("heavy", "heavy")
+        self.enqueue("heavy-batch", shared=["heavy"])
+        self.enqueue("light-batch", shared=["heavy", "light"])
+        self.drain()
+        self.assertEqual(self.order, ["light-batch", "heavy", "heavy-batch"])
+
+    def test_weights_apply_to_shared_batches(self):
+        self.scheduler.charge(4, "vip")
+        self.scheduler.charge(4, "regular")
+        self.enqueue("regular-batch", shared=["regular"])
+        self.enqueue("vip-batch", shared=["vip"])
+        self.drain()
+        self.assertEqual(self.order, ["vip-batch", "regular-batch"])
+
+    def test_shared_batch_counted_as_system_without_advancing_participants(self):
+        self.enqueue("batch", shared=["light"])
+        self.drain()
+        usage = {row["user_id"]: row["total_calls"] for row in self.scheduler.snapshot()}
+        self.assertEqual(usage[SYSTEM_USER], 2)
+        self.assertNotIn("light", usage)
+        self.assertNotIn("light", self.scheduler._finish_tags)
+
+
+class PlannerParticipantsTest(unittest.TestCase):
+    def test_batches_receive_overlapping_callers(self):
+        planner = SpotBatchPlanner(window=0.05, max_ids=2)
+        calls = []
+        barrier = threading.Barrier(2)
+
+        def fetch_batch(batch_ids, user_ids):
+            calls.append((batch_ids, sorted(user_ids)))
+            return {"CurbSpotParkingAvailabilities": []}
+
+        def query(user_id, segment_ids):
+            current_user.set(user_id)
+            barrier.wait()
+            planner.fetch("Taipei", segment_ids, fetch_batch)
+
+        threads = [threading.Thread(target=query, args=("a", ["S1", "S2"])),
+                   threading.Thread(target=query, args=("b", ["S2", "S3"]))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        demands = {"a": {"S1", "S2"}, "b": {"S2", "S3"}}
+        self.assertEqual(len(calls), 2)
+        for batch_ids, user_ids in calls:
+            self.assertEqual(user_ids, sorted(user for user, ids in demands.items() if not ids.isdisjoint(batch_ids)))
+
+
+if __name__ == "__main__":
+    unittest.main()
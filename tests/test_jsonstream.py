@@ -0,0 +1,102 @@
+import json
+import unittest
+
+from api.jsonstream import ArrayItemDecoder
+
+KEY = "CurbSpotParkingAvailabilities"
+
+SPOTS = [
+    {"ParkingSpotID": "A001", "ParkingSegmentID": "A", "SpotStatus": 2, "Note": "}, {\"x\": [1]}"},
+    {"ParkingSpotID": "A002", "ParkingSegmentID": "A", "SpotStatus": 1, "Position": {"PositionLat": 25.0}},
+    {"ParkingSpotID": "B001", "ParkingSegmentID": "B", "SpotStatus": 2, "Name": "中山北路一段🚗", "Tags": [{}]}
+]
+
+DOC = {
+    "UpdateTime": "2026-10-19T08:00:00+08:00",
+    "UpdateInterval": 60,
+    "Meta": {KEY: [{"ParkingSpotID": "nested"}]},
+    "Comment": "\"{}\": [{{\"ParkingSpotID\": \"value\"}}]".format(KEY),
+    "Keys": [KEY, {KEY: []}],
+    KEY: SPOTS,
+    "AuthorityCode": "TPE"
+}
+
+
+def decode(chunks):
+    decoder = ArrayItemDecoder(KEY)
+    items = []
+    for chunk in chunks:
+        items.extend(decoder.feed(chunk))
+    items.extend(decoder.close())
+    return items
+
+
+def split(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+class ArrayItemDecoderTest(unittest.TestCase):
+    def encodings(self, doc):
+        for separators in ((",", ":"), (", ", ": ")):
+            yield json.dumps(doc, ensure_ascii=False, separators=separators).encode()
+
+    def test_split_at_every_offset(self):
+        for raw in self.encodings(DOC):
+            for offset in range(len(raw) + 1):
+                self.assertEqual(decode([raw[:offset], raw[offset:]]), SPOTS, offset)
+
+    def test_small_chunks(self):
+        for raw in self.encodings(DOC):
+            for size in (1, 2, 3, 7, 64):
+                self.assertEqual(decode(split(raw, size)), SPOTS, size)
+
+    def test_multibyte_utf8_split(self):
+        raw = json.dumps(DOC, ensure_ascii=False).encode()
+        start = raw.index("中".encode())
+        end = raw.index("🚗".encode()) + len("🚗".encode())
+        for offset in range(start, end + 1):
+            self.assertEqual(decode([raw[:offset], raw[offset:]]), SPOTS, offset)
+
+    def test_items_returned_as_chunks_arrive(self):
+        raw = json.dumps(DOC, ensure_ascii=False).encode()
+        decoder = ArrayItemDecoder(KEY)
+        first = json.dumps(SPOTS[0], ensure_ascii=False).encode()
+        self.assertEqual(decoder.feed(raw[:raw.index(first) + len(first) + 1]), SPOTS[:1])
+
+    def test_truncated_array(self):
+        raw = json.dumps(DOC, ensure_ascii=False).encode()
+        array_end = raw.index(b"]", raw.index(json.dumps(SPOTS[-1], ensure_ascii=False).encode()))
+        for offset in range(1, array_end + 1):
+            with self.assertRaises(ValueError, msg=offset):
+                decode([raw[:offset]])
+
+    def test_empty_and_non_object_bodies(self):
+        for raw in (b"", b"  \n", b"[]", b"<html>Bad Gateway</html>", b"\"text\"", b"null"):
+            with self.assertRaises(ValueError, msg=raw):
+                decode([raw])
+
+    def test_object_without_key(self):
+        self.assertEqual(decode([b"{}"]), [])
+        self.assertEqual(decode([json.dumps({"Message": "no data", "Meta": {KEY: [1]}}).encode()]), [])
+
+    def test_nested_and_value_occurrences_ignored(self):
+        cases = [
+            {"Meta": {KEY: [{"id": "nested"}]}, KEY: [{"id": "top"}]},
+            {"Comment": "\"{}\":[{{\"id\":\"value\"}}]".format(KEY), KEY: [{"id": "top"}]},
+            {"Name": KEY, KEY: [{"id": "top"}]},
+            {"List": [{KEY: [{"id": "in array"}]}], KEY: [{"id": "top"}]}
+        ]
+        for doc in cases:
+            for raw in self.encodings(doc):
+                for size in (1, 5, len(raw)):
+                    self.assertEqual(decode(split(raw, size)), [{"id": "top"}], raw)
+
+    def test_malformed_member(self):
+        with self.assertRaises(ValueError):
+            decode([b'{"UpdateTime" 1, "' + KEY.encode() + b'": []}'])
+        with self.assertRaises(ValueError):
+            decode([b'{"' + KEY.encode() + b'": {}}'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import unittest
+from unittest import mock
+from urllib.parse import unquote
+
+os.environ.setdefault("TDX_APP_ID", "test-app")
+os.environ.setdefault("TDX_APP_KEY", "test-key")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-line-token")
+
+from api.parking import ParkingFinder  # noqa: E402
+from api.prefetch import KVUsageStore, UsageTracker, Prefetcher, PREFETCH_HEADER  # noqa: E402
+
+BASE_URL = "https://lbot.example.com"
+ALIAS = "明德路337巷"
+
+
+class FakeResponse:
+    def __init__(self, data=None, status_code=200):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeKV:
+    """以 dict 模擬 Upstash Redis REST API 的 /pipeline。"""
+
+    def __init__(self):
+        self.hash = {}
+
+    def post(self, url, json=None, timeout=None, headers=None):
+        results = []
+        for command, _, *args in json:
+            if command == "HINCRBY":
+                self.hash[args[0]] = str(int(self.hash.get(args[0], 0)) + args[1])
+                results.append({"result": int(self.hash[args[0]])})
+            elif command == "HSETNX":
+                results.append({"result": int(self.hash.setdefault(args[0], args[1]) == args[1])})
+            elif command == "HGETALL":
+                results.append({"result": [item for field in self.hash.items() for item in field]})
+        return FakeResponse(results)
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_cdn_warm_requests_public_endpoint(self):
+        tracker = UsageTracker()
+        tracker.record(ALIAS)
+        requested = []
+
+        def fake_get(url, headers=None, timeout=None):
+            requested.append((unquote(url), headers))
+            return FakeResponse()
+
+        prefetcher = Prefetcher(ParkingFinder(), tracker, addresses="", base_url=BASE_URL)
+        with mock.patch("requests.get", fake_get), mock.patch("requests.request") as tdx:
+            report = prefetcher.warm()
+        self.assertEqual(report["warmed"], [ALIAS])
+        self.assertEqual(requested, [("{}/api/parking/{}".format(BASE_URL, ALIAS), {PREFETCH_HEADER: "1"})])
+        # 由處理請求的實例查詢 TDX，排程本身不呼叫 TDX
+        tdx.assert_not_called()
+
+    def test_run_budget_follows_interval(self):
+        prefetcher = Prefetcher(ParkingFinder(), UsageTracker(), hourly_budget=180, interval=60, base_url=BASE_URL)
+        self.assertEqual(prefetcher.budget_remaining(), 3)
+
+    def test_usage_shared_through_kv(self):
+        kv = FakeKV()
+        with mock.patch("requests.post", kv.post):
+            UsageTracker(store=KVUsageStore(BASE_URL, "kv-token")).record(ALIAS)
+            UsageTracker(store=KVUsageStore(BASE_URL, "kv-token")).record("非固定地址")
+            hot = UsageTracker(store=KVUsageStore(BASE_URL, "kv-token")).hot_addresses()
+        self.assertEqual([address for address, _ in hot], [ALIAS])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+import httpx
+
+os.environ.setdefault("TDX_APP_ID", "test-app")
+os.environ.setdefault("TDX_APP_KEY", "test-key")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-line-token")
+
+from api.config import address_to_segment, group_config  # noqa: E402
+from api.parking import ParkingFinder  # noqa: E402
+
+ALIASES = ["明德路337巷", "明德路", "明德路A", "裕民六路"]
+SPOTS_PER_SEGMENT = 7
+PAGE_SIZE = 5
+
+
+def alias_segment_ids(alias):
+    return [item["id"].split(":")[0] for item in address_to_segment[alias]]
+
+
+def spot_numbers(seg_id):
+    return group_config[seg_id][0]["spots"][:SPOTS_PER_SEGMENT]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.ok = True
+        self.content = json.dumps(data).encode()
+        self.text = self.content.decode()
+        self._data = data
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class PagedTDX:
+    """依 $top / $skip 分頁回應的假 TDX，每個路段第一個分組的前 SPOTS_PER_SEGMENT 個車格都是空位。"""
+
+    def __init__(self):
+        self.spot_requests = 0
+        self._lock = threading.Lock()
+
+    def page(self, params):
+        segment_ids = re.findall(r"'([^']+)'", params["$filter"].split(" and ")[0])
+        spots = sorted(({"ParkingSpotID": "{}{:03d}".format(seg_id, int(number)), "ParkingSegmentID": seg_id,
+                         "SpotStatus": 2, "DataCollectTime": "2026-10-19T08:00:00+08:00"}
+                        for seg_id in segment_ids for number in spot_numbers(seg_id)),
+                       key=lambda spot: spot["ParkingSpotID"])
+        skip = int(params.get("$skip", 0))
+        with self._lock:
+            self.spot_requests += 1
+        return {"CurbSpotParkingAvailabilities": spots[skip:skip + int(params["$top"])]}
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if "token" in url:
+            return FakeResponse({"access_token": "token", "expires_in": 86400})
+        return FakeResponse(self.page(kwargs["params"]))
+
+    def handle_async(self, request):
+        if "token" in str(request.url):
+            return httpx.Response(200, json={"access_token": "token", "expires_in": 86400})
+        return httpx.Response(200, json=self.page(dict(request.url.params)))
+
+
+class SpotPagingTest(unittest.TestCase):
+    def setUp(self):
+        self.tdx = PagedTDX()
+        async_client = httpx.AsyncClient
+        patches = [
+            mock.patch("requests.request", self.tdx.request),
+            mock.patch("httpx.AsyncClient",
+                       lambda **kwargs: async_client(transport=httpx.MockTransport(self.tdx.handle_async), **kwargs)),
+            mock.patch("api.parking.SPOT_PAGE_SIZE", PAGE_SIZE),
+            mock.patch("api.async_parking.SPOT_PAGE_SIZE", PAGE_SIZE)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.finder = ParkingFinder()
+
+    def assert_complete(self, alias, result):
+        self.assertTrue(result["ok"], result["error_msgs"])
+        expected = sum(len(spot_numbers(seg_id)) for seg_id in alias_segment_ids(alias))
+        self.assertEqual(len(result["available_spot_ids"]), expected)
+
+    def test_merged_sync_queries_page_past_top(self):
+        results = {}
+
+        def query(alias):
+            results[alias] = self.finder.find_grouped_parking_data(alias)
+
+        threads = [threading.Thread(target=query, args=(alias,)) for alias in ALIASES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        for alias in ALIASES:
+            self.assert_complete(alias, results[alias])
+        self.assertGreater(self.tdx.spot_requests, 1)
+
+    def test_merged_async_queries_page_past_top(self):
+        async def main():
+            return await asyncio.gather(*[self.finder.async_finder.find_grouped_parking_data(alias)
+                                          for alias in ALIASES])
+
+        for alias, result in zip(ALIASES, asyncio.run(main())):
+            self.assert_complete(alias, result)
+
+    def test_spot_number_query_pages(self):
+        result = self.finder.find_grouped_parking_data(ALIASES[0], "0")
+        self.assertTrue(result["ok"], result["error_msgs"])
+
+
+if __name__ == "__main__":
+    unittest.main()